@@ -0,0 +1,222 @@
+"""
+Benchmarks of the HassDatabase fetch methods, format_dataframe and the time
+helpers on synthetic recorder databases of several sizes.
+
+Requires pytest-benchmark. Run with:
+
+    python -m pytest benchmarks/bench_detective.py
+
+Every benchmark records the peak memory traced while running it once and,
+on Linux, how far that run raised the RSS of the process above its RSS
+before the call, in its extra_info. The peak RSS is reset before every
+call, so the numbers of a benchmark don't depend on the ones before it.
+
+Save a run with --benchmark-autosave and gate on regressions against it
+with --benchmark-compare --benchmark-compare-fail=mean:10%.
+
+Environment variables:
+- DETECTIVE_BENCH_SIZES (default: 10000,100000): Numbers of states of the
+    generated databases.
+- DETECTIVE_BENCH_DIR (default: a pytest temporary directory): Directory
+    to keep the generated databases in between runs.
+- DETECTIVE_IMPORT_BUDGET (default: 0.5): Seconds a cold start of Python
+    importing detective.core may take.
+"""
+
+import ctypes
+import gc
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from detective import functions, time
+from detective.core import HassDatabase
+from generate_db import END_TS, generate
+
+pytest.importorskip("pytest_benchmark")
+
+SIZES = [
+    int(size)
+    for size in os.environ.get("DETECTIVE_BENCH_SIZES", "10000,100000").split(",")
+]
+IMPORT_BUDGET = float(os.environ.get("DETECTIVE_IMPORT_BUDGET", "0.5"))
+DAYS = 30
+START_TS = END_TS - DAYS * 86400
+
+
+def _entities(states):
+    """Scale the number of entities with the states, up to 1000."""
+    return min(1000, max(20, states // 1000))
+
+
+@pytest.fixture(scope="session", params=SIZES, ids=lambda size: f"{size}_states")
+def size(request):
+    return request.param
+
+
+@pytest.fixture(scope="session")
+def db(size, tmp_path_factory):
+    directory = os.environ.get("DETECTIVE_BENCH_DIR")
+    directory = Path(directory) if directory else tmp_path_factory.getbasetemp()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"recorder-{_entities(size)}-{size}.db"
+    if not path.exists():
+        generate(path, entities=_entities(size), states=size, days=DAYS)
+    db = HassDatabase(f"sqlite:///{path}")
+    yield db
+    db.close()
+
+
+@pytest.fixture(scope="session")
+def raw_states(db):
+    return db.fetch_all_data_of(("sensor.*",), limit=None)
+
+
+@pytest.fixture(scope="session")
+def datetimes(size):
+    rng = np.random.default_rng(0)
+    epochs = rng.uniform(START_TS, END_TS, size)
+    return pd.Series(pd.to_datetime(epochs, unit="s", utc=True))
+
+
+try:
+    _libc = ctypes.CDLL("libc.so.6")
+except OSError:  # Not glibc
+    _libc = None
+
+
+def _memory_kb(field):
+    """Read a memory field, like VmRSS, of /proc/self/status in kilobytes."""
+    with open("/proc/self/status") as file:
+        return int(re.search(rf"^{field}:\s+(\d+) kB", file.read(), re.M)[1])
+
+
+def peak_rss_mb(func, *args, **kwargs):
+    """
+    Run func once and return how far it raised the peak RSS of the process
+    above the RSS before the call, or None if the peak can't be reset.
+    """
+    gc.collect()
+    if _libc is not None:
+        # Return freed memory to the OS, or the call reuses it unnoticed.
+        _libc.malloc_trim(0)
+    try:
+        # Writing 5 resets the peak RSS (VmHWM) to the current RSS.
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:  # Not Linux
+        return None
+    before = _memory_kb("VmRSS")
+    func(*args, **kwargs)
+    return (_memory_kb("VmHWM") - before) / 1024
+
+
+def run(benchmark, func, *args, **kwargs):
+    """Benchmark func, recording its peak traced memory and peak RSS."""
+    rss = peak_rss_mb(func, *args, **kwargs)
+    if rss is not None:
+        benchmark.extra_info["peak_rss_mb"] = rss
+
+    tracemalloc.start()
+    func(*args, **kwargs)
+    benchmark.extra_info["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+
+    return benchmark(func, *args, **kwargs)
+
+
+def test_fetch_all_data_of(benchmark, db):
+    run(benchmark, db.fetch_all_data_of, ("sensor.*",), limit=None)
+
+
+def test_fetch_all_data_of_time_range(benchmark, db):
+    run(
+        benchmark,
+        db.fetch_all_data_of,
+        ("sensor.power_*",),
+        limit=None,
+        start=END_TS - 86400,
+        end=END_TS,
+    )
+
+
+def test_fetch_all_sensor_data(benchmark, db):
+    run(benchmark, db.fetch_all_sensor_data, limit=None)
+
+
+def test_fetch_all_sensor_data_with_attributes(benchmark, db):
+    attributes = functions.DEFAULT_ATTRIBUTES
+    run(benchmark, db.fetch_all_sensor_data, limit=None, attributes=attributes)
+
+
+def test_iter_all_data_of(benchmark, db):
+    run(benchmark, lambda: sum(len(df) for df in db.iter_all_data_of(("sensor.*",))))
+
+
+def test_fetch_many(benchmark, db):
+    run(benchmark, db.fetch_many, ("binary_sensor.*", "light.*"))
+
+
+def test_fetch_all_statistics_of(benchmark, db):
+    run(benchmark, db.fetch_all_statistics_of, ("sensor.*",), limit=None)
+
+
+def test_fetch_aggregated(benchmark, db):
+    run(benchmark, db.fetch_aggregated, ("sensor.*",), "1h")
+
+
+def test_fetch_series(benchmark, db):
+    run(benchmark, db.fetch_series, ("sensor.*",), "1h")
+
+
+def test_fetch_matrix(benchmark, db):
+    run(
+        benchmark,
+        db.fetch_matrix,
+        ("sensor.*",),
+        start=END_TS - 86400,
+        end=END_TS,
+        freq="5min",
+    )
+
+
+def test_format_dataframe(benchmark, raw_states):
+    run(benchmark, functions.format_dataframe, raw_states)
+
+
+@pytest.mark.parametrize(
+    "helper",
+    [time.time_categories, time.weekday_mask, time.localize_series],
+    ids=lambda helper: helper.__name__,
+)
+def test_time_helpers(benchmark, datetimes, helper):
+    run(benchmark, helper, datetimes)
+
+
+def test_sqlalch_datetimes(benchmark, datetimes):
+    strings = datetimes.dt.strftime(time.SQLALCHEMY_FORMAT)
+    run(benchmark, time.sqlalch_datetimes, strings)
+
+
+def test_import_detective_core(benchmark):
+    """Cold start of a process connecting to a database, without pandas."""
+    command = [sys.executable, "-c", "import detective.core"]
+    timings = []
+
+    def start():
+        started = perf_counter()
+        subprocess.run(command, check=True)
+        timings.append(perf_counter() - started)
+
+    # Timed here too, as there are no benchmark stats with --benchmark-disable.
+    benchmark.pedantic(start, rounds=5)
+    assert statistics.median(timings) < IMPORT_BUDGET
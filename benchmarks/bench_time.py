@@ -0,0 +1,56 @@
+"""
+Compare the scalar helpers of detective.time applied per row with their
+vectorized versions.
+
+Run with: python benchmarks/bench_time.py [rows]
+"""
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from detective import time
+
+
+def main(rows=1_000_000):
+    rng = np.random.default_rng(0)
+    epochs = rng.uniform(1.6e9, 1.7e9, rows)
+    series = pd.Series(pd.to_datetime(epochs, unit="s", utc=True))
+    strings = pd.Series(series.dt.strftime(time.SQLALCHEMY_FORMAT))
+
+    cases = [
+        (
+            "time_category",
+            lambda: series.apply(time.time_category),
+            lambda: time.time_categories(series),
+        ),
+        (
+            "is_weekday",
+            lambda: series.apply(time.is_weekday),
+            lambda: time.weekday_mask(series),
+        ),
+        (
+            "localize",
+            lambda: series.apply(time.localize),
+            lambda: time.localize_series(series),
+        ),
+        (
+            "sqlalch_datetime",
+            lambda: strings.apply(time.sqlalch_datetime),
+            lambda: time.sqlalch_datetimes(strings),
+        ),
+    ]
+
+    print(f"{'helper':<18}{'scalar (s)':>12}{'vectorized (s)':>16}{'speedup':>10}")
+    for name, scalar, vectorized in cases:
+        scalar_time = min(timeit.repeat(scalar, number=1, repeat=3))
+        vectorized_time = min(timeit.repeat(vectorized, number=1, repeat=3))
+        print(
+            f"{name:<18}{scalar_time:>12.3f}{vectorized_time:>16.4f}"
+            f"{scalar_time / vectorized_time:>9.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,246 @@
+"""
+Generate a synthetic Home Assistant recorder database to benchmark on.
+
+The schema, including the indexes, is copied from tests/test.db. Entities are
+a mix of numeric sensors, binary sensors, lights and persons whose states
+are spread over the last `days` before a fixed end time, in the order the
+recorder would insert them. Like the recorder, identical attributes are
+stored once in state_attributes, and the numeric sensors get hourly
+statistics and 5 minute short term statistics.
+
+Run with: python benchmarks/generate_db.py PATH [--entities N] [--states N]
+"""
+
+import argparse
+import json
+import sqlite3
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+SCHEMA_DB = Path(__file__).resolve().parent.parent / "tests" / "test.db"
+# A fixed end time keeps the generated databases reproducible.
+END_TS = 1700000000.0
+# Number of states generated and inserted at a time.
+CHUNKSIZE = 100_000
+# Share of the states that are "unavailable".
+UNAVAILABLE = 0.002
+# Brightness levels a light reports while on, each its own attributes row.
+BRIGHTNESS_LEVELS = 8
+
+# Kinds of entities: domain, object_id prefix, share of the entities, state
+# changes relative to the other kinds, and the states of enum entities.
+KINDS = (
+    ("sensor", "power", 0.3, 8.0, None),
+    ("sensor", "temperature", 0.3, 2.0, None),
+    ("binary_sensor", "motion", 0.2, 1.0, ("on", "off")),
+    ("light", "lamp", 0.15, 0.5, ("on", "off")),
+    ("person", "person", 0.05, 0.2, ("home", "not_home")),
+)
+UNITS = {"power": "W", "temperature": "°C"}
+
+
+def _entities(entities, rng):
+    """Return the entity_ids, kind, relative rate and attributes of entities."""
+    shares = np.array([kind[2] for kind in KINDS])
+    kinds = rng.choice(len(KINDS), size=entities, p=shares / shares.sum())
+    kinds.sort()
+    entity_ids, attributes = [], []
+    for i, kind in enumerate(kinds):
+        domain, prefix, _, _, options = KINDS[kind]
+        object_id = f"{prefix}_{i + 1:05d}"
+        name = object_id.replace("_", " ").title()
+        entity_ids.append(f"{domain}.{object_id}")
+        if options is None:
+            blobs = [
+                {
+                    "state_class": "measurement",
+                    "unit_of_measurement": UNITS[prefix],
+                    "device_class": prefix,
+                    "friendly_name": name,
+                }
+            ]
+        elif domain == "light":
+            off = {"supported_color_modes": ["brightness"], "friendly_name": name}
+            blobs = [off] + [
+                {**off, "color_mode": "brightness", "brightness": level * 32}
+                for level in range(1, BRIGHTNESS_LEVELS + 1)
+            ]
+        else:
+            blobs = [{"device_class": prefix, "friendly_name": name}]
+        attributes.append(blobs)
+    rates = np.array([KINDS[kind][3] for kind in kinds])
+    return entity_ids, kinds, rates, attributes
+
+
+def _numeric_values(entity, times, rng):
+    """Daily cycles plus noise, different for every entity."""
+    phase = (entity * 0.7) % (2 * np.pi)
+    base = 20 + (entity % 7) * 50
+    amplitude = 5 + (entity % 5) * 10
+    values = base + amplitude * np.sin(2 * np.pi * times / 86400 + phase)
+    return values + rng.normal(0, amplitude / 20, len(times))
+
+
+def _insert_states(con, entities, kinds, rates, attribute_ids, states, days, rng):
+    start_ts = END_TS - days * 86400
+    rates = rates / rates.sum() * states / (END_TS - start_ts)
+    windows = max(1, states // CHUNKSIZE)
+    bounds = np.linspace(start_ts, END_TS, windows + 1)
+    inserted = 0
+
+    for window_start, window_end in zip(bounds[:-1], bounds[1:]):
+        counts = rng.poisson(rates * (window_end - window_start))
+        entity = np.repeat(np.arange(len(entities)), counts)
+        times = window_start + rng.random(len(entity)) * (window_end - window_start)
+        order = np.argsort(times, kind="stable")
+        entity, times = entity[order], times[order]
+        kind = kinds[entity]
+
+        values = np.empty(len(entity), dtype=object)
+        attributes = attribute_ids[entity]
+        for k, (domain, _, _, _, options) in enumerate(KINDS):
+            mask = kind == k
+            if not mask.any():
+                continue
+            if options is None:
+                numbers = _numeric_values(entity[mask], times[mask], rng)
+                values[mask] = np.char.mod("%.1f", numbers)
+                continue
+            choice = rng.integers(len(options), size=mask.sum())
+            values[mask] = np.asarray(options, dtype=object)[choice]
+            if domain == "light":
+                level = rng.integers(1, BRIGHTNESS_LEVELS + 1, size=mask.sum())
+                attributes[mask] += np.where(choice == 0, level, 0)
+        values[rng.random(len(entity)) < UNAVAILABLE] = "unavailable"
+
+        con.executemany(
+            "INSERT INTO states "
+            "(state, last_updated_ts, attributes_id, metadata_id, origin_idx) "
+            "VALUES (?, ?, ?, ?, 0)",
+            zip(
+                values.tolist(),
+                times.tolist(),
+                attributes.tolist(),
+                (entity + 1).tolist(),
+            ),
+        )
+        inserted += len(entity)
+        print(f"Inserted {inserted} states", end="\r")
+    print()
+    return inserted
+
+
+def _insert_statistics(con, table, metadata_ids, entities, period, start_ts):
+    """Insert a statistics row per numeric sensor and period since start_ts."""
+    starts = np.arange(start_ts - start_ts % period, END_TS - period + 1, period)
+    rng = np.random.default_rng(len(starts))
+    for metadata_id, entity in zip(metadata_ids, entities):
+        samples = starts[:, None] + np.linspace(0, period, 7)[None, :]
+        values = _numeric_values(entity, samples.ravel(), rng).reshape(samples.shape)
+        con.executemany(
+            f"INSERT INTO {table} "
+            "(created_ts, metadata_id, start_ts, mean, min, max) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            zip(
+                (starts + period + 10).tolist(),
+                [metadata_id] * len(starts),
+                starts.tolist(),
+                values.mean(axis=1).tolist(),
+                values.min(axis=1).tolist(),
+                values.max(axis=1).tolist(),
+            ),
+        )
+
+
+def generate(
+    path, entities=1000, states=1_000_000, days=30, short_term_days=10, seed=0
+):
+    """
+    Write a recorder database with `entities` entities and about `states`
+    states over the last `days` days to `path`, which must not exist.
+    Returns the number of states.
+    """
+    rng = np.random.default_rng(seed)
+    with sqlite3.connect(SCHEMA_DB) as schema_con:
+        schema = schema_con.execute(
+            "SELECT type, sql FROM sqlite_master WHERE sql IS NOT NULL"
+        ).fetchall()
+
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode = OFF")
+    con.execute("PRAGMA synchronous = OFF")
+    for kind, sql in schema:
+        if kind == "table":
+            con.execute(sql)
+
+    entity_ids, kinds, rates, attributes = _entities(entities, rng)
+    con.executemany(
+        "INSERT INTO states_meta (metadata_id, entity_id) VALUES (?, ?)",
+        enumerate(entity_ids, start=1),
+    )
+    blobs = [
+        json.dumps(blob, separators=(",", ":"))
+        for blobs in attributes
+        for blob in blobs
+    ]
+    con.executemany(
+        "INSERT INTO state_attributes (attributes_id, hash, shared_attrs) "
+        "VALUES (?, ?, ?)",
+        ((i, zlib.crc32(blob.encode()), blob) for i, blob in enumerate(blobs, start=1)),
+    )
+    attribute_ids = np.cumsum([0] + [len(blobs) for blobs in attributes[:-1]]) + 1
+
+    inserted = _insert_states(
+        con, entity_ids, kinds, rates, attribute_ids, states, days, rng
+    )
+
+    numeric = [i for i, kind in enumerate(kinds) if KINDS[kind][4] is None]
+    con.executemany(
+        "INSERT INTO statistics_meta "
+        "(id, statistic_id, source, unit_of_measurement, has_mean, has_sum, name) "
+        "VALUES (?, ?, 'recorder', ?, 1, 0, NULL)",
+        (
+            (i, entity_ids[entity], UNITS[KINDS[kinds[entity]][1]])
+            for i, entity in enumerate(numeric, start=1)
+        ),
+    )
+    metadata_ids = range(1, len(numeric) + 1)
+    _insert_statistics(
+        con, "statistics", metadata_ids, numeric, 3600, END_TS - days * 86400
+    )
+    _insert_statistics(
+        con,
+        "statistics_short_term",
+        metadata_ids,
+        numeric,
+        300,
+        END_TS - min(days, short_term_days) * 86400,
+    )
+
+    for kind, sql in schema:
+        if kind == "index":
+            con.execute(sql)
+    con.commit()
+    con.close()
+    return inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--entities", type=int, default=1000)
+    parser.add_argument("--states", type=int, default=1_000_000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if Path(args.path).exists():
+        parser.error(f"{args.path} already exists")
+
+    states = generate(args.path, args.entities, args.states, args.days, seed=args.seed)
+    print(f"Generated {args.entities} entities and {states} states in {args.path}")
+
+
+if __name__ == "__main__":
+    main()
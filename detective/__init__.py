@@ -1 +1,46 @@
-# To do
+"""
+Explore and analyse the data in a Home Assistant database.
+
+The submodules and the main classes are imported on first access, so
+`import detective` is fast and doesn't load pandas.
+"""
+
+import importlib
+
+_SUBMODULES = (
+    "aio",
+    "auth",
+    "cache",
+    "cli",
+    "config",
+    "core",
+    "functions",
+    "intervals",
+    "time",
+)
+# Names exported by the package and the submodule that defines them.
+_EXPORTS = {
+    "HassDatabase": "core",
+    "db_from_hass_config": "core",
+    "AsyncHassDatabase": "aio",
+    "ParquetCache": "cache",
+    "StateIntervals": "intervals",
+    "OnlineStats": "functions",
+}
+
+# Only names that load neither pandas nor optional extras, so that
+# `from detective import *` stays fast.
+__all__ = ["HassDatabase", "db_from_hass_config", "AsyncHassDatabase"]
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    if name in _EXPORTS:
+        module = importlib.import_module(f".{_EXPORTS[name]}", __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted([*globals(), *_EXPORTS, *_SUBMODULES])
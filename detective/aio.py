@@ -0,0 +1,323 @@
+"""
+Asynchronous access to the Home Assistant database, for use in event loops.
+"""
+
+from __future__ import annotations
+
+import logging
+from time import perf_counter
+from typing import TYPE_CHECKING, AsyncIterator, Dict, Tuple
+
+from sqlalchemy import make_url, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from .core import (
+    DEFAULT_CHUNKSIZE,
+    DEFAULT_POOL_SIZE,
+    STATES_ORDER,
+    STATISTICS_ORDER,
+    QueryStats,
+    _build_frame,
+    _engine_arguments,
+    _limit_frame,
+    _nbytes,
+    _QueryBuilder,
+    _register_sqlite_functions,
+    stripped_db_url,
+)
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+_LOGGER = logging.getLogger(__name__)
+
+# The asyncio driver used for each database type.
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+    "mysql": "aiomysql",
+}
+# Drivers that already support asyncio and are kept when given in the URL.
+KNOWN_ASYNC_DRIVERS = ("aiosqlite", "asyncpg", "aiomysql", "asyncmy", "psycopg")
+
+
+def async_url(url):
+    """Return the URL with the driver replaced by the asyncio driver."""
+    url = make_url(url)
+    backend, _, driver = url.drivername.partition("+")
+    if driver in KNOWN_ASYNC_DRIVERS:
+        return url
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError("No asyncio driver is known for {} databases".format(backend))
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+
+class AsyncHassDatabase(_QueryBuilder):
+    """
+    Asynchronous counterpart of HassDatabase built on the SQLAlchemy asyncio
+    engine, so queries don't block the event loop of e.g. a dashboard.
+
+    The fetch methods are coroutines and the iter methods async iterators,
+    with the same arguments and results as those of HassDatabase:
+
+        async with AsyncHassDatabase(url) as db:
+            df = await db.fetch_all_data_of(("sensor.*_power",))
+            async for chunk in db.iter_all_data_of(("sensor.*_power",)):
+                ...
+
+    Concurrent fetches each check out a connection from the pool.
+    """
+
+    def __init__(
+        self,
+        url,
+        *,
+        backend="pandas",
+        pool_size=DEFAULT_POOL_SIZE,
+        read_only=False,
+        explain=False,
+        on_query=None,
+    ):
+        """
+        Parameters
+        ----------
+        url : str
+            The URL to the database. The driver is replaced by its asyncio
+            counterpart: aiosqlite, asyncpg or aiomysql, which has to be
+            installed.
+        backend, pool_size, read_only, explain, on_query
+            As for HassDatabase.
+
+        Creating the database doesn't connect yet. Use it as an async context
+        manager, which connects and fetches the entities, or await
+        `fetch_entities()`, and await `close()` when done.
+        """
+        super().__init__(url, backend, explain, on_query)
+        engine_url, options = _engine_arguments(url, self.db_type, pool_size, read_only)
+        try:
+            self.engine = create_async_engine(async_url(engine_url), **options)
+        except ImportError:
+            raise RuntimeError(
+                "The asyncio driver for your database is missing. Please make "
+                "sure that {} is installed.".format(ASYNC_DRIVERS.get(self.db_type))
+            ) from None
+        if self.db_type == "sqlite":
+            _register_sqlite_functions(self.engine.sync_engine)
+
+    async def __aenter__(self):
+        await self.fetch_entities()
+        _LOGGER.info("Successfully connected to database %s", stripped_db_url(self.url))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self) -> None:
+        """Close all pooled connections to the database."""
+        await self.engine.dispose()
+
+    def _require_metadata_ids(self) -> None:
+        if self.metadata_ids is None:
+            raise RuntimeError("Await fetch_metadata_ids() before resolving entities")
+
+    def _require_statistics_metadata_ids(self) -> None:
+        if self.statistics_metadata_ids is None:
+            raise RuntimeError(
+                "Await fetch_statistics_metadata_ids() before resolving statistics"
+            )
+
+    async def perform_query(self, query, **params):
+        """
+        Perform a query.
+
+        The rows are fetched before the connection is returned to the pool,
+        so the result can be used after the call.
+        """
+        stats = QueryStats(str(query))
+        try:
+            if isinstance(query, str):
+                query = text(query)
+            async with self.engine.connect() as conn:
+                started = perf_counter()
+                result = await conn.execute(query, params)
+                stats.execute = perf_counter() - started
+                frozen = result.freeze()
+                stats.rows = len(frozen.data)
+        except:
+            _LOGGER.error("Error with query: %s", query)
+            raise
+        self._record(stats)
+        return frozen()
+
+    async def fetch_entities(self) -> None:
+        """Fetch entities for which we have data."""
+        response = await self.perform_query(
+            "SELECT DISTINCT(entity_id) FROM states_meta"
+        )
+        self.entities = [e[0] for e in response]
+        _LOGGER.info("There are %d entities with data", len(self.entities))
+
+    async def fetch_metadata_ids(self) -> Dict[str, int]:
+        """Fetch and cache the mapping of entity_id to states metadata_id."""
+        response = await self.perform_query(
+            "SELECT entity_id, metadata_id FROM states_meta"
+        )
+        self.metadata_ids = {
+            entity_id: metadata_id for entity_id, metadata_id in response
+        }
+        return self.metadata_ids
+
+    async def fetch_statistics_metadata_ids(self) -> Dict[str, int]:
+        """Fetch and cache the mapping of statistic_id to statistics_meta id."""
+        response = await self.perform_query(
+            "SELECT statistic_id, id FROM statistics_meta"
+        )
+        self.statistics_metadata_ids = {
+            statistic_id: metadata_id for statistic_id, metadata_id in response
+        }
+        return self.statistics_metadata_ids
+
+    async def _load_metadata_ids(self) -> None:
+        if self.metadata_ids is None:
+            await self.fetch_metadata_ids()
+
+    async def _load_statistics_metadata_ids(self) -> None:
+        if self.statistics_metadata_ids is None:
+            await self.fetch_statistics_metadata_ids()
+
+    async def _read_query(self, query, params=None, order_by=None, limit=None):
+        """
+        Run a query and load the full result into a frame, like
+        HassDatabase._read_query. The asyncio drivers buffer the rows while
+        executing, so the fetch time is included in the execute time.
+        """
+        params = params or {}
+        _LOGGER.debug(query)
+        stats = QueryStats(query)
+        query = self._text(query, params)
+        frames = []
+        async with self.engine.connect() as con:
+            for batch in self._batched(params):
+                started = perf_counter()
+                result = await con.execute(query, batch)
+                stats.execute += perf_counter() - started
+                started = perf_counter()
+                frames.append(
+                    _build_frame(list(result.keys()), result.fetchall(), self.backend)
+                )
+                stats.build += perf_counter() - started
+            if self.explain:
+                explain = self._explain_query(query, params)
+                result = await con.execute(explain, next(self._batched(params)))
+                stats.plan = self._format_plan(result.fetchall())
+        return self._merge(frames, stats, order_by, limit)
+
+    async def _iter_query(
+        self, query, chunksize, params=None, limit=None
+    ) -> AsyncIterator:
+        """
+        Run a query and yield the result as frames of at most `chunksize`
+        rows, streaming them from a server side cursor, and stop after
+        `limit` rows in total.
+        """
+        params = params or {}
+        _LOGGER.debug(query)
+        stats = QueryStats(query)
+        query = self._text(query, params)
+        try:
+            async with self.engine.connect() as con:
+                for batch in self._batched(params):
+                    started = perf_counter()
+                    result = await con.stream(query, batch)
+                    stats.execute += perf_counter() - started
+                    names = list(result.keys())
+                    partitions = result.partitions(chunksize).__aiter__()
+                    while True:
+                        started = perf_counter()
+                        try:
+                            rows = await partitions.__anext__()
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            stats.fetch += perf_counter() - started
+                        started = perf_counter()
+                        frame = _build_frame(names, rows, self.backend)
+                        stats.build += perf_counter() - started
+                        stats.rows += len(rows)
+                        frame = _limit_frame(frame, stats, limit, self.backend)
+                        stats.bytes += _nbytes(frame, self.backend)
+                        yield frame
+                        if limit is not None and stats.rows >= limit:
+                            return
+        finally:
+            self._record(stats)
+
+    async def fetch_all_data_of(
+        self,
+        sensors: Tuple[str],
+        limit=50000,
+        start=None,
+        end=None,
+        after=None,
+        since_state_id=None,
+    ) -> pd.DataFrame:
+        """
+        Fetch data for sensors, see HassDatabase.fetch_all_data_of.
+        """
+        await self._load_metadata_ids()
+        params = {}
+        query = self._data_of_query(
+            sensors, limit, start, end, after, since_state_id, params
+        )
+        return await self._read_query(query, params, STATES_ORDER, limit)
+
+    async def fetch_all_statistics_of(
+        self, sensors: Tuple[str], limit=50000, start=None, end=None
+    ) -> pd.DataFrame:
+        """
+        Fetch aggregated statistics for sensors, see
+        HassDatabase.fetch_all_statistics_of.
+        """
+        await self._load_statistics_metadata_ids()
+        params = {}
+        query = self._statistics_of_query(sensors, limit, start, end, params)
+        return await self._read_query(query, params, STATISTICS_ORDER, limit)
+
+    async def iter_all_data_of(
+        self,
+        sensors: Tuple[str],
+        chunksize=DEFAULT_CHUNKSIZE,
+        limit=None,
+        start=None,
+        end=None,
+        since_state_id=None,
+    ) -> AsyncIterator[pd.DataFrame]:
+        """
+        Stream data for sensors as frames of `chunksize` rows, see
+        HassDatabase.iter_all_data_of.
+        """
+        await self._load_metadata_ids()
+        params = {}
+        query = self._data_of_query(
+            sensors, limit, start, end, None, since_state_id, params
+        )
+        async for chunk in self._iter_query(query, chunksize, params, limit):
+            yield chunk
+
+    async def iter_all_statistics_of(
+        self,
+        sensors: Tuple[str],
+        chunksize=DEFAULT_CHUNKSIZE,
+        limit=None,
+        start=None,
+        end=None,
+    ) -> AsyncIterator[pd.DataFrame]:
+        """
+        Stream aggregated statistics for sensors as frames of `chunksize`
+        rows, see HassDatabase.iter_all_statistics_of.
+        """
+        await self._load_statistics_metadata_ids()
+        params = {}
+        query = self._statistics_of_query(sensors, limit, start, end, params)
+        async for chunk in self._iter_query(query, chunksize, params, limit):
+            yield chunk
@@ -0,0 +1,202 @@
+"""
+Local Parquet cache of recorder history.
+"""
+
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Tuple
+from urllib.parse import unquote
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from . import time
+from .core import (
+    DEFAULT_CHUNKSIZE,
+    STATES_ORDER,
+    HassDatabase,
+    _from_arrow,
+    _to_arrow,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# Columns stored in the cache, partitioned on entity_id and month.
+CACHE_SCHEMA = pa.schema(
+    [
+        ("state", pa.string()),
+        ("last_updated_ts", pa.float64()),
+        ("state_id", pa.int64()),
+        ("entity_id", pa.string()),
+        ("month", pa.string()),
+    ]
+)
+PARTITIONING = ds.partitioning(
+    pa.schema([("entity_id", pa.string()), ("month", pa.string())]),
+    flavor="hive",
+)
+# The leading underscore keeps pyarrow from reading it as a data file.
+MANIFEST = "_manifest.json"
+
+
+class ParquetCache:
+    """
+    Cache of the states of a HassDatabase in Parquet files partitioned per
+    entity and month.
+
+    For every cached entity the manifest keeps a high-water mark: the
+    largest state_id of the database when the entity was last refreshed.
+    A refresh only reads the states recorded since, everything else is
+    served from the Parquet files, pruned by entity, month and
+    last_updated_ts. States purged from the database stay in the cache.
+    """
+
+    def __init__(self, db: HassDatabase, path):
+        """
+        Parameters
+        ----------
+        db : HassDatabase
+            The database to cache the states of.
+        path : str
+            The directory to store the Parquet files in.
+        """
+        self.db = db
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.high_water_marks: Dict[str, int] = {}
+
+        manifest = self.path / MANIFEST
+        if manifest.exists():
+            with manifest.open() as fp:
+                self.high_water_marks = json.load(fp)["high_water_marks"]
+
+    def _save_manifest(self) -> None:
+        manifest = self.path / MANIFEST
+        tmp = manifest.with_suffix(".tmp")
+        with tmp.open("w") as fp:
+            json.dump({"high_water_marks": self.high_water_marks}, fp)
+        os.replace(tmp, manifest)
+
+    def refresh(self, entities: Tuple[str], chunksize=DEFAULT_CHUNKSIZE) -> int:
+        """
+        Copy the states recorded since the last refresh of `entities` to the
+        cache and return the number of new rows.
+
+        Entities refreshed together share a high-water mark, so they are
+        read with a single query on the state_id primary key. Files left
+        by a refresh that failed before saving its high-water marks are
+        removed first, so retrying it doesn't duplicate states.
+        """
+        entities = self.db.resolve_entities(entities)
+        latest = self.db.perform_query("SELECT MAX(state_id) FROM states").scalar()
+        if latest is None:
+            return 0
+
+        groups: Dict[int, list] = {}
+        for entity in entities:
+            groups.setdefault(self.high_water_marks.get(entity, 0), []).append(entity)
+
+        rows = 0
+        for high_water_mark, group in groups.items():
+            if high_water_mark >= latest:
+                continue
+            self._remove_above(group, high_water_mark)
+            chunks = self.db.iter_all_data_of(
+                group, chunksize=chunksize, since_state_id=high_water_mark
+            )
+            for chunk in chunks:
+                table = _to_arrow(chunk, self.db.backend)
+                # States recorded while refreshing are left for the next one.
+                table = table.filter(pc.less_equal(table["state_id"], latest))
+                rows += self._write(table)
+            for entity in group:
+                self.high_water_marks[entity] = latest
+
+        self._save_manifest()
+        _LOGGER.info("Added %d rows to the cache at %s", rows, self.path)
+        return rows
+
+    def _remove_above(self, entities, high_water_mark) -> None:
+        """Remove the files of entities with states above their mark."""
+        entities = set(entities)
+        for path in self.path.glob("entity_id=*/month=*/part-*.parquet"):
+            entity = unquote(path.parent.parent.name.partition("=")[2])
+            first_state_id = int(path.name.split("-")[1])
+            if entity in entities and first_state_id > high_water_mark:
+                path.unlink()
+
+    def _write(self, table: pa.Table) -> int:
+        """
+        Write states to the cache, in files named after the state_id range
+        of the table so every write gets its own files.
+        """
+        if table.num_rows == 0:
+            return 0
+        name = "{}-{}".format(
+            pc.min(table["state_id"]).as_py(), pc.max(table["state_id"]).as_py()
+        )
+        table = table.append_column("month", _months(table["last_updated_ts"]))
+        ds.write_dataset(
+            table.select(CACHE_SCHEMA.names).cast(CACHE_SCHEMA),
+            self.path,
+            format="parquet",
+            partitioning=PARTITIONING,
+            basename_template=f"part-{name}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+        return table.num_rows
+
+    def fetch_all_data_of(
+        self, sensors: Tuple[str], start=None, end=None, refresh=True
+    ):
+        """
+        Fetch data for sensors from the cache, newest first, in the same
+        layout and backend as HassDatabase.fetch_all_data_of.
+
+        Arguments:
+        - sensors: entity_ids or glob patterns such as `sensor.*_power`.
+        - start, end (default: None): Only load state changes with
+            start <= last_updated_ts < end.
+        - refresh (default: True): Copy new states from the database first.
+        """
+        if refresh:
+            self.refresh(sensors)
+        entities = self.db.resolve_entities(sensors)
+        cached = [e for e in entities if e in self.high_water_marks]
+
+        expression = pc.field("entity_id").isin(cached)
+        if start is not None:
+            start = time.to_timestamp(start)
+            expression &= pc.field("month") >= _month(start)
+            expression &= pc.field("last_updated_ts") >= start
+        if end is not None:
+            end = time.to_timestamp(end)
+            expression &= pc.field("month") <= _month(end)
+            expression &= pc.field("last_updated_ts") < end
+
+        if cached:
+            dataset = ds.dataset(
+                self.path, format="parquet", partitioning=PARTITIONING
+            )
+            table = dataset.to_table(filter=expression)
+        else:
+            table = CACHE_SCHEMA.empty_table()
+
+        table = table.select(["state", "last_updated_ts", "entity_id", "state_id"])
+        table = table.sort_by([(column, "descending") for column in STATES_ORDER])
+        _LOGGER.info("The cache returned %d rows of data", table.num_rows)
+        return _from_arrow(table, self.db.backend)
+
+
+def _months(timestamps):
+    """Format epoch timestamps as their YYYY-MM month partition."""
+    micros = pc.round(pc.multiply(timestamps.cast(pa.float64()), 1e6))
+    return pc.strftime(micros.cast(pa.int64()).cast(pa.timestamp("us")), "%Y-%m")
+
+
+def _month(timestamp) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m")
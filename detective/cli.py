@@ -0,0 +1,204 @@
+"""
+The `detective` command line tool, to export recorder history unattended,
+e.g. from cron:
+
+    detective export --entities 'sensor.*' --since 2025-01-01 --out export/
+
+The states are streamed from the database in chunks and written to a file
+per entity and UTC day, in Hive style directories like
+export/entity_id=sensor.power/date=2025-01-01/part.parquet, so pyarrow,
+polars and DuckDB can read them back as a single dataset. Every export
+rewrites the whole files of the days it covers, so running it again
+replaces them instead of duplicating states.
+"""
+
+import argparse
+import logging
+import math
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+
+from . import config, time
+from .core import DEFAULT_CHUNKSIZE, HassDatabase
+
+_LOGGER = logging.getLogger(__name__)
+
+# The file extension of every export format.
+FORMATS = {"parquet": "parquet", "csv": "csv", "arrow": "arrow"}
+# Log the progress of an export at most this often, in seconds.
+PROGRESS_INTERVAL = 10
+DAY = 86400
+
+
+def _connect(args) -> HassDatabase:
+    """Connect to the database given, or the one of the HASS config."""
+    url = args.db_url
+    if url is None:
+        path = args.config or config.find_hass_config()
+        url = config.db_url_from_hass_config(path)
+    return HassDatabase(url, fetch_entities=False, read_only=True)
+
+
+def _write(frame, path, fmt) -> None:
+    """Write a frame to path, replacing any previous export atomically."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    if fmt == "parquet":
+        frame.to_parquet(tmp, index=False)
+    elif fmt == "csv":
+        frame.to_csv(tmp, index=False)
+    else:
+        frame.to_feather(tmp)
+    os.replace(tmp, path)
+
+
+def _day_bounds(since, until):
+    """Widen [since, until) to whole UTC days, so every day is complete."""
+    start = end = None
+    if since is not None:
+        start = math.floor(time.to_timestamp(since) / DAY) * DAY
+    if until is not None:
+        end = math.ceil(time.to_timestamp(until) / DAY) * DAY
+    return start, end
+
+
+def _days(chunks):
+    """
+    Regroup the chunks of a single entity, newest first, into one frame per
+    UTC day, yielded once all of its states were read.
+    """
+    import pandas as pd
+
+    pending = []
+    pending_day = None
+    for chunk in chunks:
+        days = chunk["last_updated_ts"].to_numpy() // DAY
+        for day in pd.unique(days):
+            if pending and day != pending_day:
+                yield pending_day, pd.concat(pending, ignore_index=True)
+                pending = []
+            pending_day = day
+            pending.append(chunk[days == day])
+    if pending:
+        yield pending_day, pd.concat(pending, ignore_index=True)
+
+
+def _write_day(frame, out, entity_id, day, fmt) -> None:
+    """Write the states of an entity on a UTC day, replacing its file."""
+    date = datetime.fromtimestamp(day * DAY, timezone.utc).strftime("%Y-%m-%d")
+    frame = frame.drop(columns="entity_id").sort_values(
+        ["last_updated_ts", "state_id"], ignore_index=True
+    )
+    path = out / f"entity_id={entity_id}" / f"date={date}" / f"part.{FORMATS[fmt]}"
+    _write(frame, path, fmt)
+
+
+def export(args) -> int:
+    """Export the states of entities, returns the number of rows."""
+    out = Path(args.out)
+    with _connect(args) as db:
+        entities = db.resolve_entities(args.entities)
+        if not entities:
+            _LOGGER.warning("No entities match %s", ", ".join(args.entities))
+            return 0
+        _LOGGER.info("Exporting %d entities to %s", len(entities), out)
+
+        start, end = _day_bounds(args.since, args.until)
+        started = reported = perf_counter()
+        rows = files = 0
+        for entity_id in entities:
+            chunks = db.iter_all_data_of(
+                (entity_id,), chunksize=args.chunksize, start=start, end=end
+            )
+            for day, frame in _days(chunk for chunk in chunks if len(chunk)):
+                _write_day(frame, out, entity_id, day, args.format)
+                rows += len(frame)
+                files += 1
+                now = perf_counter()
+                if now - reported >= PROGRESS_INTERVAL:
+                    reported = now
+                    _LOGGER.info(
+                        "Exported %d rows, %.0f rows/s", rows, rows / (now - started)
+                    )
+
+    elapsed = perf_counter() - started
+    _LOGGER.info(
+        "Exported %d rows to %d files in %.1f s, %.0f rows/s",
+        rows,
+        files,
+        elapsed,
+        rows / elapsed if elapsed else 0,
+    )
+    return rows
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="detective", description="Tools for studying Home Assistant data."
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="only log warnings and errors"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="also log the SQL queries"
+    )
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument(
+        "--config", help="Home Assistant config dir (default: discovered)"
+    )
+    source.add_argument("--db-url", help="database URL (default: from the config)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser(
+        "export", help="export states, partitioned by entity and day"
+    )
+    export_parser.add_argument(
+        "--entities",
+        nargs="+",
+        required=True,
+        help="entity ids or patterns, e.g. 'sensor.*'",
+    )
+    export_parser.add_argument(
+        "--since", help="only export the days from this ISO 8601 date on"
+    )
+    export_parser.add_argument(
+        "--until", help="only export the days before this ISO 8601 date"
+    )
+    export_parser.add_argument(
+        "--format", choices=FORMATS, default="parquet", help="(default: parquet)"
+    )
+    export_parser.add_argument("--out", required=True, help="output directory")
+    export_parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=DEFAULT_CHUNKSIZE,
+        help=f"rows read at a time (default: {DEFAULT_CHUNKSIZE})",
+    )
+    export_parser.set_defaults(func=export)
+    return parser
+
+
+def main(argv=None) -> int:
+    """Run the command line tool, returns the exit code."""
+    args = _parser().parse_args(argv)
+    level = logging.INFO
+    if args.quiet:
+        level = logging.WARNING
+    elif args.verbose:
+        level = logging.DEBUG
+    logging.basicConfig(
+        level=level, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    try:
+        args.func(args)
+    except Exception:
+        _LOGGER.exception("%s failed", args.command)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,13 +2,19 @@
 Helper functions for config.
 """
 
+import copy
+import fnmatch
+import logging
 import os
+import threading
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from ruamel.yaml import YAML
 from ruamel.yaml.constructor import SafeConstructor
 
+_LOGGER = logging.getLogger(__name__)
+
 _CONFIGURATION_PATH: Optional[Path] = None
 
 
@@ -38,29 +44,117 @@ class HassSafeConstructor(SafeConstructor):
     """Hass specific SafeConstructor."""
 
 
+# Parsed YAML files and secrets, keyed on their path, with the stamp of every
+# file and directory they were built from so they are only parsed again when
+# one of those changed.
+_CACHE: Dict[Tuple[str, str], Tuple[Dict[str, Optional[tuple]], Any]] = {}
+# The file being loaded and its dependencies, for each level of includes.
+_LOADING: List[Tuple[Path, Dict[str, Optional[tuple]]]] = []
+# YAML parsers per level of includes, as a parser is not reentrant.
+_PARSERS: List[YAML] = []
+# Files found by walking up from a directory and the paths checked before,
+# reset for every load.
+_FOUND: Dict[Tuple[Path, str], Tuple[Path, List[str]]] = {}
+_LOCK = threading.RLock()
+
+
+def clear_config_cache():
+    """Forget all parsed YAML files."""
+    with _LOCK:
+        _CACHE.clear()
+
+
+def _stamp(path) -> Optional[tuple]:
+    """Return the modification time and size of a path, None if missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _depend(dependencies) -> None:
+    """Make the file being loaded depend on files or directories."""
+    if _LOADING:
+        _LOADING[-1][1].update(dependencies)
+
+
+def _parser(depth) -> YAML:
+    while len(_PARSERS) <= depth:
+        yaml = YAML(typ="safe")
+        # Compat with HASS
+        yaml.allow_duplicate_keys = True
+        # Stub HASS constructors
+        yaml.Constructor = HassSafeConstructor
+        _PARSERS.append(yaml)
+    return _PARSERS[depth]
+
+
+def _load_cached(fname, kind="config"):
+    """
+    Parse a YAML file, or return the cached result if neither it nor any
+    file it included changed. Secrets are parsed without the HASS tags.
+    """
+    path = Path(fname).resolve()
+    key = (kind, str(path))
+    cached = _CACHE.get(key)
+    if cached is not None and all(
+        _stamp(dependency) == stamp for dependency, stamp in cached[0].items()
+    ):
+        _depend(cached[0])
+        return cached[1]
+
+    dependencies = {str(path): _stamp(path)}
+    _LOADING.append((path, dependencies))
+    try:
+        yaml = YAML(typ="safe") if kind == "secrets" else _parser(len(_LOADING))
+        with open(path, encoding="utf-8") as conf_file:
+            # If configuration file is empty YAML returns None
+            # We convert that to an empty dict
+            value = yaml.load(conf_file) or {}
+    finally:
+        _LOADING.pop()
+
+    _CACHE[key] = (dependencies, value)
+    _depend(dependencies)
+    return value
+
+
+def _find_up(dirpath: Path, name) -> Path:
+    """
+    Find `name` in dirpath or the closest parent directory containing it,
+    stopping at the configuration directory. Lookups are remembered for the
+    duration of a load.
+    """
+    key = (dirpath, name)
+    if key not in _FOUND:
+        fname = dirpath / name
+        missing = []
+        for _ in range(len(dirpath.parts)):
+            if fname.exists() or dirpath == _CONFIGURATION_PATH:
+                break
+            missing.append(str(fname))
+            dirpath = dirpath.parent
+            fname = dirpath / name
+        _FOUND[key] = (fname, missing)
+    fname, missing = _FOUND[key]
+    # A file created closer by would be found instead.
+    _depend(dict.fromkeys(missing))
+    return fname
+
+
 def _secret_yaml(loader, node):
     """Load secrets and embed it into the configuration YAML."""
-    dirpath = Path(os.path.dirname(loader.name))
-
     # Recursively search for the secrets.yaml file
     # this might be needed when a yaml file is included like
     # `!included folder/file.yaml`. Same rules as
     # https://www.home-assistant.io/docs/configuration/secrets/#debugging-secrets
-    fname = dirpath / "secrets.yaml"
-    for _ in range(len(dirpath.parts)):
-        if fname.exists() or (
-            _CONFIGURATION_PATH is not None
-            and _CONFIGURATION_PATH.exists()
-            and dirpath.samefile(_CONFIGURATION_PATH)
-        ):
-            break
-        dirpath = dirpath.parent
-        fname = dirpath / "secrets.yaml"
+    fname = _find_up(_LOADING[-1][0].parent, "secrets.yaml")
 
     try:
-        with fname.open() as secret_file:
-            secrets = YAML(typ="safe").load(secret_file)
+        secrets = _load_cached(fname, kind="secrets")
     except FileNotFoundError:
+        _depend({str(fname): None})
         raise ValueError("Secrets file {} not found".format(fname)) from None
 
     try:
@@ -75,19 +169,62 @@ def _include_yaml(loader, node):
     Example:
         device_tracker: !include device_tracker.yaml
     """
-    dirpath = Path(os.path.dirname(loader.name))
-    fname = dirpath / node.value
-    for _ in range(len(dirpath.parts)):
-        if fname.exists() or (
-            _CONFIGURATION_PATH is not None
-            and _CONFIGURATION_PATH.exists()
-            and dirpath.samefile(_CONFIGURATION_PATH)
-        ):
-            break
-        dirpath = dirpath.parent
-        fname = dirpath / node.value
+    return _load_cached(_find_up(_LOADING[-1][0].parent, node.value))
+
+
+def _include_dir_files(loader, node) -> List[Path]:
+    """
+    Return the YAML files in the directory of an !include_dir_* node and
+    its subdirectories, sorted, skipping hidden files and secrets.yaml.
+    """
+    directory = _LOADING[-1][0].parent / node.value
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [name for name in dirs if not name.startswith(".")]
+        # Adding or removing a file changes the stamp of its directory.
+        _depend({root: _stamp(root)})
+        files.extend(
+            Path(root) / name
+            for name in names
+            if fnmatch.fnmatch(name, "*.yaml")
+            and not name.startswith(".")
+            and name != "secrets.yaml"
+        )
+    if not files:
+        _depend({str(directory): _stamp(directory)})
+    return sorted(files)
+
+
+def _include_dir_list_yaml(loader, node):
+    """Load the files in a directory as a list, one item per file."""
+    return [_load_cached(fname) for fname in _include_dir_files(loader, node)]
+
+
+def _include_dir_merge_list_yaml(loader, node):
+    """Load the files in a directory, each a list, as a single list."""
+    merged = []
+    for fname in _include_dir_files(loader, node):
+        loaded = _load_cached(fname)
+        if isinstance(loaded, list):
+            merged.extend(loaded)
+    return merged
+
 
-    return load_yaml(os.path.join(dirpath, node.value))
+def _include_dir_named_yaml(loader, node):
+    """Load the files in a directory as a dict keyed on their file name."""
+    return {
+        fname.stem: _load_cached(fname) for fname in _include_dir_files(loader, node)
+    }
+
+
+def _include_dir_merge_named_yaml(loader, node):
+    """Load the files in a directory, each a dict, as a single dict."""
+    merged = {}
+    for fname in _include_dir_files(loader, node):
+        loaded = _load_cached(fname)
+        if isinstance(loaded, dict):
+            merged.update(loaded)
+    return merged
 
 
 def _stub_tag(constructor, node):
@@ -98,7 +235,7 @@ def _stub_tag(constructor, node):
         seen = constructor._stub_seen = set()
 
     if node.tag not in seen:
-        print("YAML tag {} is not supported".format(node.tag))
+        _LOGGER.warning("YAML tag %s is not supported", node.tag)
         seen.add(node.tag)
 
     return {}
@@ -107,10 +244,14 @@ def _stub_tag(constructor, node):
 HassSafeConstructor.add_constructor("!include", _include_yaml)
 HassSafeConstructor.add_constructor("!env_var", _stub_tag)
 HassSafeConstructor.add_constructor("!secret", _secret_yaml)
-HassSafeConstructor.add_constructor("!include_dir_list", _stub_tag)
-HassSafeConstructor.add_constructor("!include_dir_merge_list", _stub_tag)
-HassSafeConstructor.add_constructor("!include_dir_named", _stub_tag)
-HassSafeConstructor.add_constructor("!include_dir_merge_named", _stub_tag)
+HassSafeConstructor.add_constructor("!include_dir_list", _include_dir_list_yaml)
+HassSafeConstructor.add_constructor(
+    "!include_dir_merge_list", _include_dir_merge_list_yaml
+)
+HassSafeConstructor.add_constructor("!include_dir_named", _include_dir_named_yaml)
+HassSafeConstructor.add_constructor(
+    "!include_dir_merge_named", _include_dir_merge_named_yaml
+)
 
 
 def load_hass_config(path):
@@ -119,18 +260,37 @@ def load_hass_config(path):
 
 
 def load_yaml(fname):
-    """Load a YAML file."""
-    yaml = YAML(typ="safe")
-    # Compat with HASS
-    yaml.allow_duplicate_keys = True
-    # Stub HASS constructors
-    HassSafeConstructor.name = fname
-    yaml.Constructor = HassSafeConstructor
+    """
+    Load a YAML file.
+
+    Parsed files are cached with the modification time and size of the
+    files and directories they include, so loading a config tree again only
+    parses the files that changed. Returns a copy of the cached result.
+    """
+    with _LOCK:
+        if not _LOADING:
+            _FOUND.clear()
+        return copy.deepcopy(_load_cached(fname))
+
 
-    with open(fname, encoding="utf-8") as conf_file:
-        # If configuration file is empty YAML returns None
-        # We convert that to an empty dict
-        return yaml.load(conf_file) or {}
+def _integration_config(config, domain):
+    """
+    Return the configuration of an integration, from the configuration
+    itself or from one of the packages in `homeassistant: packages`.
+    """
+    if config.get(domain) is not None:
+        return config[domain]
+    packages = (config.get("homeassistant") or {}).get("packages") or {}
+    for package in packages.values():
+        if isinstance(package, dict) and package.get(domain) is not None:
+            return package[domain]
+    return None
+
+
+def time_zone_from_hass_config(path):
+    """Find the time zone, e.g. Europe/Amsterdam, from a HASS config dir."""
+    config = load_hass_config(path)
+    return (config.get("homeassistant") or {}).get("time_zone")
 
 
 def db_url_from_hass_config(path):
@@ -141,7 +301,7 @@ def db_url_from_hass_config(path):
     default_path = os.path.join(path, "home-assistant_v2.db")
     default_url = "sqlite:///{}".format(default_path)
 
-    recorder = config.get("recorder")
+    recorder = _integration_config(config, "recorder")
 
     if recorder:
         db_url = recorder.get("db_url")
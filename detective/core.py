@@ -1,14 +1,104 @@
 """
 Classes and functions for parsing home-assistant data.
+
+pandas and numpy are imported on first use, so importing this module to e.g.
+count entities stays fast.
 """
 
-from typing import Tuple
+from __future__ import annotations
+
+import fnmatch
+import json
+import logging
+import math
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from pathlib import Path
+from time import perf_counter, sleep
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
 from urllib.parse import urlparse
 
-import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import bindparam, create_engine, event, make_url, text
+
+from . import config, time
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+_LOGGER = logging.getLogger(__name__)
+
+# Number of rows per dataframe yielded by the iter_* methods.
+DEFAULT_CHUNKSIZE = 10000
+# Maximum number of metadata_ids bound in a single IN clause, larger entity
+# lists are queried in batches and merged.
+ENTITY_BATCH_SIZE = 500
+# Columns the fetch methods sort their results on, newest first.
+STATES_ORDER = ["last_updated_ts", "state_id"]
+STATISTICS_ORDER = ["created_ts"]
+# Number of connections HassDatabase keeps open for reuse.
+DEFAULT_POOL_SIZE = 5
+# Frame types the fetch methods can return.
+BACKENDS = ("pandas", "arrow", "polars")
+# Number of queries HassDatabase keeps the QueryStats of for stats().
+QUERY_HISTORY = 1000
+# Rows converted to Arrow at a time by the arrow and polars backends, so
+# only a slice of a result is ever held both as Python objects and Arrow.
+ARROW_BATCH_SIZE = 65536
 
-from . import config, functions
+# Dialect specific SQL, keyed on get_db_type.
+# Start of the time bucket of an epoch timestamp column.
+BUCKET_SQL = {
+    "sqlite": "CAST({column} / :bucket AS INTEGER) * :bucket",
+    "postgresql": "FLOOR({column} / :bucket) * :bucket",
+    "mysql": "FLOOR({column} / :bucket) * :bucket",
+}
+# Condition that a text column holds a number. SQLite has no REGEXP
+# function of its own, _register_sqlite_functions adds it.
+NUMBER_REGEX = "^[-+]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][-+]?[0-9]+)?$"
+NUMERIC_SQL = {
+    "sqlite": "{column} REGEXP '" + NUMBER_REGEX + "'",
+    "postgresql": "{column} ~ '" + NUMBER_REGEX + "'",
+    "mysql": "{column} REGEXP '" + NUMBER_REGEX + "'",
+}
+# Prefix that makes a query return its plan instead of its rows. The
+# PostgreSQL, MySQL and MariaDB variants run the query to measure it.
+# MariaDB doesn't support EXPLAIN ANALYZE and has ANALYZE instead.
+EXPLAIN_SQL = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "postgresql": "EXPLAIN ANALYZE ",
+    "mysql": "EXPLAIN ANALYZE ",
+    "mariadb": "ANALYZE FORMAT=JSON ",
+}
+# Cast of a text column to a float.
+FLOAT_SQL = {
+    "sqlite": "CAST({column} AS REAL)",
+    "postgresql": "CAST({column} AS DOUBLE PRECISION)",
+    "mysql": "CAST({column} AS DOUBLE)",
+}
+# Long-term statistics tables with the period in seconds of their rows,
+# from coarse to fine, and the aggregate of each statistics column.
+STATISTICS_TABLES = (("statistics", 3600), ("statistics_short_term", 300))
+STATISTICS_AGGREGATES = {
+    "mean": "AVG({table}.mean)",
+    "min": "MIN({table}.min)",
+    "max": "MAX({table}.max)",
+}
+# Aggregates fetch_aggregated computes over the values in a bucket. first
+# and last use the rank of the state in its bucket by last_updated_ts.
+AGGREGATES = {
+    "mean": "AVG(value)",
+    "min": "MIN(value)",
+    "max": "MAX(value)",
+    "sum": "SUM(value)",
+    "count": "COUNT(value)",
+    "first": "MAX(CASE WHEN first_rank = 1 THEN value END)",
+    "last": "MAX(CASE WHEN last_rank = 1 THEN value END)",
+}
 
 
 def db_from_hass_config(path=None, **kwargs):
@@ -36,25 +126,730 @@ def stripped_db_url(url):
     ).geturl()
 
 
-class HassDatabase:
+def _engine_arguments(url, db_type, pool_size, read_only):
+    """Return the url and keyword arguments to create a pooled engine with."""
+    url = make_url(url)
+    options = {}
+
+    if db_type == "sqlite":
+        in_memory = url.database in (None, "", ":memory:")
+        if not in_memory:
+            # Pooled connections are handed out to any thread.
+            options["connect_args"] = {"check_same_thread": False}
+            options["pool_size"] = pool_size
+        if read_only and not in_memory:
+            url = url.set(
+                database=f"file:{url.database}",
+                query={**url.query, "mode": "ro", "uri": "true"},
+            )
+    else:
+        options["pool_size"] = pool_size
+        # Recycle connections the server closed while they sat in the pool.
+        options["pool_pre_ping"] = True
+
+    return url, options
+
+
+@lru_cache(maxsize=32)
+def _compile(pattern):
+    return re.compile(pattern)
+
+
+def _regexp(pattern, value) -> Optional[bool]:
+    if value is None:
+        return None
+    return _compile(pattern).search(value) is not None
+
+
+def _register_sqlite_functions(engine) -> None:
+    """
+    Add the REGEXP function to every connection of a SQLite engine, with
+    the semantics of Python's re.search like MySQL and PostgreSQL have.
+    """
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.create_function("regexp", 2, _regexp, deterministic=True)
+
+
+def _seconds(duration) -> float:
+    """Convert a pandas timedelta string or number of seconds to seconds."""
+    if isinstance(duration, (int, float)):
+        return float(duration)
+    import pandas as pd
+
+    return pd.Timedelta(duration).total_seconds()
+
+
+def _time_shards(start, end, period):
+    """Split [start, end) in ranges of `period`, newest first."""
+    start = time.to_timestamp(start)
+    end = time.to_timestamp(end)
+    step = _seconds(period)
+    bounds = [start + step * i for i in range(int((end - start) // step) + 1)]
+    if bounds[-1] < end:
+        bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))[::-1]
+
+
+def _split_ranges(ranges, lo, hi):
+    """
+    Split time ranges into the parts inside [lo, hi) and the parts outside,
+    returned as two lists of (start, end) tuples.
+    """
+    inside, outside = [], []
+    for start, end in ranges:
+        if max(start, lo) < min(end, hi):
+            inside.append((max(start, lo), min(end, hi)))
+        if start < min(end, lo):
+            outside.append((start, min(end, lo)))
+        if max(start, hi) < end:
+            outside.append((max(start, hi), end))
+    return inside, outside
+
+
+def _arrow_table(names, rows):
+    """
+    Transpose result rows into a columnar Arrow table, ARROW_BATCH_SIZE
+    rows at a time.
+    """
+    import pyarrow as pa
+
+    tables = []
+    for i in range(0, max(len(rows), 1), ARROW_BATCH_SIZE):
+        batch = rows[i : i + ARROW_BATCH_SIZE]
+        columns = zip(*batch) if batch else [()] * len(names)
+        tables.append(pa.table([pa.array(column) for column in columns], names=names))
+    return _concat(tables, "arrow")
+
+
+def _adbc_uri(url, db_type, backend) -> Optional[str]:
+    """
+    Return the URI to read a SQLite database with straight into Arrow with
+    the ADBC driver, or None if it is not installed or not used.
+    """
+    if db_type != "sqlite" or backend == "pandas":
+        return None
+    try:
+        import adbc_driver_sqlite.dbapi  # noqa: F401
+    except ImportError:
+        return None
+    database = make_url(url).database
+    if database in (None, "", ":memory:") or database.startswith("file:"):
+        return None
+    return Path(database).resolve().as_uri() + "?mode=ro"
+
+
+def _concat(frames, backend):
+    """Concatenate frames of the given backend."""
+    if len(frames) == 1:
+        return frames[0]
+    if backend == "pandas":
+        import pandas as pd
+
+        return pd.concat(frames, ignore_index=True)
+    if backend == "arrow":
+        import pyarrow as pa
+
+        # Batches where a column is all NULL or integer promote to the others.
+        return pa.concat_tables(frames, promote_options="permissive")
+
+    import polars as pl
+
+    return pl.concat(frames, how="diagonal_relaxed")
+
+
+def _sort(frame, columns, backend, descending=False):
+    """Sort a frame of the given backend on columns."""
+    if backend == "pandas":
+        return frame.sort_values(
+            columns, ascending=not descending, ignore_index=True, kind="stable"
+        )
+    if backend == "arrow":
+        order = "descending" if descending else "ascending"
+        return frame.sort_by([(column, order) for column in columns])
+    return frame.sort(columns, descending=descending, maintain_order=True)
+
+
+def _head(frame, n, backend):
+    """Return the first n rows of a frame of the given backend."""
+    if backend == "arrow":
+        return frame.slice(0, n)
+    return frame.head(n)
+
+
+def _last(frame, column, backend):
+    """Return the value of a column in the last row of a frame."""
+    if backend == "pandas":
+        return frame[column].iloc[-1]
+    if backend == "arrow":
+        return frame[column][-1].as_py()
+    return frame[column][-1]
+
+
+def _save_watermark(path, since_state_id) -> None:
+    """Write a tail watermark to a JSON file, replacing it atomically."""
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.tmp")
+    with tmp.open("w") as fp:
+        json.dump({"since_state_id": int(since_state_id)}, fp)
+    os.replace(tmp, path)
+
+
+def _limit_frame(frame, stats, limit, backend):
+    """
+    Cut the last frame of a streamed query to the rows left of `limit`,
+    given the rows counted in its stats including this frame.
+    """
+    if limit is None or stats.rows <= limit:
+        return frame
+    excess = stats.rows - limit
+    stats.rows = limit
+    return _head(frame, len(frame) - excess, backend)
+
+
+def _epoch_to_datetime(frame, column, backend):
+    """
+    Convert a column of UTC epoch timestamps to naive UTC datetimes on the
+    client, so the query can select the raw, indexed column on every dialect.
+    """
+    if backend == "pandas":
+        import pandas as pd
+
+        frame[column] = pd.to_datetime(frame[column], unit="s")
+        return frame
+    if backend == "arrow":
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        micros = pc.round(pc.multiply(frame[column].cast(pa.float64()), 1e6))
+        datetimes = micros.cast(pa.int64()).cast(pa.timestamp("us"))
+        return frame.set_column(
+            frame.column_names.index(column), column, datetimes
+        )
+
+    import polars as pl
+
+    micros = (pl.col(column).cast(pl.Float64) * 1e6).round()
+    return frame.with_columns(micros.cast(pl.Int64).cast(pl.Datetime("us")))
+
+
+def _nbytes(frame, backend) -> int:
+    """Return the size in memory of a frame of the given backend."""
+    if backend == "pandas":
+        return int(frame.memory_usage(index=False, deep=True).sum())
+    if backend == "arrow":
+        return frame.nbytes
+    return int(frame.estimated_size())
+
+
+def _build_frame(names, rows, backend):
+    """Build a frame of the given backend from result rows."""
+    if backend == "pandas":
+        import pandas as pd
+
+        return pd.DataFrame.from_records(rows, columns=names, coerce_float=True)
+    return _from_arrow(_arrow_table(names, rows), backend)
+
+
+def _from_arrow(table, backend):
+    """Return an Arrow table as a frame of the arrow or polars backend."""
+    if backend == "polars":
+        import polars as pl
+
+        return pl.from_arrow(table)
+    return table
+
+
+@dataclass
+class QueryStats:
+    """
+    Where the time of a query went, in seconds, and the size of its result.
+
+    - execute: Sending the query until the database returned the cursor.
+    - fetch: Fetching the rows from the cursor.
+    - build: Building, merging and sorting the frames.
+    - plan: The query plan, if the database was created with explain=True.
+    """
+
+    query: str
+    execute: float = 0.0
+    fetch: float = 0.0
+    build: float = 0.0
+    rows: int = 0
+    bytes: int = 0
+    plan: Optional[str] = None
+
+    @property
+    def total(self) -> float:
+        return self.execute + self.fetch + self.build
+
+
+def _to_pandas(frame, backend):
+    if backend == "pandas":
+        return frame
+    return frame.to_pandas()
+
+
+def _to_arrow(frame, backend):
+    if backend == "pandas":
+        import pyarrow as pa
+
+        return pa.Table.from_pandas(frame, preserve_index=False)
+    if backend == "polars":
+        return frame.to_arrow()
+    return frame
+
+
+def _from_arrow(table, backend):
+    if backend == "pandas":
+        return table.to_pandas()
+    if backend == "polars":
+        import polars as pl
+
+        return pl.from_arrow(table)
+    return table
+
+
+def _from_pandas(df, backend):
+    if backend == "arrow":
+        import pyarrow as pa
+
+        return pa.Table.from_pandas(df, preserve_index=False)
+    if backend == "polars":
+        import polars as pl
+
+        return pl.from_pandas(df)
+    return df
+
+
+class _QueryBuilder:
+    """
+    State and query building shared by HassDatabase and AsyncHassDatabase.
+    """
+
+    def __init__(self, url, backend, explain, on_query):
+        if backend not in BACKENDS:
+            raise ValueError(
+                "Unknown backend {}, expected one of {}".format(backend, BACKENDS)
+            )
+        if backend != "pandas":
+            try:
+                import pyarrow  # noqa: F401
+
+                if backend == "polars":
+                    import polars  # noqa: F401
+            except ImportError:
+                raise RuntimeError(
+                    "The {} backend requires pyarrow{}. Please make sure that "
+                    "it is installed.".format(
+                        backend, " and polars" if backend == "polars" else ""
+                    )
+                ) from None
+
+        self.url = url
+        self.db_type = get_db_type(url)
+        self.backend = backend
+        self.entities = None
+        self.metadata_ids = None
+        self.statistics_metadata_ids = None
+        self.explain = explain
+        self.on_query = on_query
+        self.queries = deque(maxlen=QUERY_HISTORY)
+
+    def _require_metadata_ids(self) -> None:
+        """Load the metadata_ids if they were not fetched yet."""
+        if self.metadata_ids is None:
+            self.fetch_metadata_ids()
+
+    def _require_statistics_metadata_ids(self) -> None:
+        """Load the statistics metadata_ids if they were not fetched yet."""
+        if self.statistics_metadata_ids is None:
+            self.fetch_statistics_metadata_ids()
+
+    def resolve_metadata_ids(self, entities=(), domains=()) -> List[int]:
+        """
+        Resolve entities to the metadata_id they are stored under in the
+        states table, so queries can use the metadata_id indexes.
+
+        Arguments:
+        - entities: entity_ids or glob patterns, e.g. `sensor.*_power`.
+        - domains: domains to include all entities of, e.g. `sensor`.
+        """
+        return sorted(
+            self.metadata_ids[entity]
+            for entity in self.resolve_entities(entities, domains)
+        )
+
+    def resolve_entities(self, entities=(), domains=()) -> List[str]:
+        """
+        Resolve entity_ids, glob patterns and domains to the sorted list of
+        matching entity_ids that have data.
+        """
+        self._require_metadata_ids()
+
+        matched = set()
+        for entity in entities:
+            if entity in self.metadata_ids:
+                matched.add(entity)
+            elif any(char in entity for char in "*?["):
+                matched.update(fnmatch.filter(self.metadata_ids, entity))
+        prefixes = tuple(f"{domain}." for domain in domains)
+        if prefixes:
+            matched.update(e for e in self.metadata_ids if e.startswith(prefixes))
+
+        return sorted(matched)
+
+    def resolve_statistics_metadata_ids(self, sensors) -> List[int]:
+        """
+        Resolve statistic_ids or glob patterns to their statistics_meta id.
+
+        Statistics imported from an external source are similar to entity_id,
+        but use a : instead of a . as a delimiter between the domain and
+        object ID, both variants are matched.
+        """
+        self._require_statistics_metadata_ids()
+
+        matched = set()
+        for sensor in sensors:
+            for statistic_id in (sensor, sensor.replace(".", ":")):
+                if statistic_id in self.statistics_metadata_ids:
+                    matched.add(statistic_id)
+                elif any(char in statistic_id for char in "*?["):
+                    matched.update(
+                        fnmatch.filter(self.statistics_metadata_ids, statistic_id)
+                    )
+
+        return sorted(self.statistics_metadata_ids[s] for s in matched)
+
+    @staticmethod
+    def _text(query, params):
+        """Build a text query, expanding list parameters into IN lists."""
+        return text(query).bindparams(
+            *(
+                bindparam(key, expanding=True)
+                for key, value in params.items()
+                if isinstance(value, (list, tuple))
+            )
+        )
+
+    @staticmethod
+    def _batched(params) -> Iterator[dict]:
+        """
+        Split the metadata_ids parameter in batches of ENTITY_BATCH_SIZE so
+        queries for thousands of entities stay within the database limits.
+        """
+        metadata_ids = params.get("metadata_ids")
+        if metadata_ids is None or len(metadata_ids) <= ENTITY_BATCH_SIZE:
+            yield params
+            return
+
+        for i in range(0, len(metadata_ids), ENTITY_BATCH_SIZE):
+            yield {**params, "metadata_ids": metadata_ids[i : i + ENTITY_BATCH_SIZE]}
+
+    def _explain_query(self, query, params):
+        """Return the query that explains the plan of `query`."""
+        explain = self._dialect_sql(EXPLAIN_SQL)
+        # The MySQL dialect knows it is talking to MariaDB once connected.
+        if getattr(self.engine.dialect, "is_mariadb", False):
+            explain = EXPLAIN_SQL["mariadb"]
+        return self._text(explain + query.text, params)
+
+    @staticmethod
+    def _format_plan(rows) -> str:
+        # SQLite returns (id, parent, notused, detail), the others one column.
+        return "\n".join(str(row[-1]) for row in rows)
+
+    def _record(self, stats: QueryStats) -> None:
+        """Log, keep and report the stats of a completed query."""
+        _LOGGER.debug(
+            "Query returned %d rows (%d bytes) in %.3fs: "
+            "execute %.3fs, fetch %.3fs, build %.3fs",
+            stats.rows,
+            stats.bytes,
+            stats.total,
+            stats.execute,
+            stats.fetch,
+            stats.build,
+        )
+        if stats.plan is not None:
+            _LOGGER.debug("Query plan:\n%s", stats.plan)
+        self.queries.append(stats)
+        if self.on_query is not None:
+            self.on_query(stats)
+
+    def stats(self) -> pd.DataFrame:
+        """
+        Summarize the last QUERY_HISTORY queries per SQL statement: the
+        number of runs, the total and mean seconds, the seconds spent
+        executing, fetching and building and the rows and bytes returned,
+        slowest first.
+        """
+        import pandas as pd
+
+        columns = ["query", "execute", "fetch", "build", "rows", "bytes"]
+        df = pd.DataFrame([asdict(stats) for stats in self.queries], columns=columns)
+        df["seconds"] = df["execute"] + df["fetch"] + df["build"]
+        summary = df.groupby("query").agg(
+            count=("seconds", "size"),
+            seconds=("seconds", "sum"),
+            mean=("seconds", "mean"),
+            execute=("execute", "sum"),
+            fetch=("fetch", "sum"),
+            build=("build", "sum"),
+            rows=("rows", "sum"),
+            bytes=("bytes", "sum"),
+        )
+        return summary.sort_values("seconds", ascending=False)
+
+    def _merge(self, frames, stats, order_by=None, limit=None, descending=True):
+        """
+        Merge the frames of a batched query, sorted on `order_by` if given
+        and cut to `limit` rows, and record the query.
+        """
+        started = perf_counter()
+        df = _concat(frames, self.backend)
+        if len(frames) > 1 and order_by:
+            df = _sort(df, order_by, self.backend, descending=descending)
+            if limit is not None:
+                df = _head(df, limit, self.backend)
+        stats.build += perf_counter() - started
+        stats.rows = len(df)
+        stats.bytes = _nbytes(df, self.backend)
+        self._record(stats)
+        return df
+
+    def _expand_attributes(self, frame, attributes):
+        from . import functions
+
+        df = functions.expand_attributes(_to_pandas(frame, self.backend), attributes)
+        return _from_pandas(df, self.backend)
+
+    @staticmethod
+    def _time_bounds(column, start, end, params) -> List[str]:
+        """Return the conditions that restrict `column` to [start, end)."""
+        conditions = []
+        if start is not None:
+            params["start"] = time.to_timestamp(start)
+            conditions.append(f"{column} >= :start")
+        if end is not None:
+            params["end"] = time.to_timestamp(end)
+            conditions.append(f"{column} < :end")
+        return conditions
+
+    @staticmethod
+    def _keyset_bound(after, params) -> List[str]:
+        """
+        Return the condition that only keeps states older than `after`, a
+        (last_updated_ts, state_id) tuple taken from the last row of a page.
+
+        The bound uses the stored last_updated_ts of the state_id, as a
+        timestamp converted to a datetime doesn't round trip to the same
+        float. The given last_updated_ts is only used if the state was
+        purged in the meantime.
+        """
+        if after is None:
+            return []
+        params["after_ts"] = time.to_timestamp(after[0])
+        params["after_id"] = int(after[1])
+        after_ts = (
+            "COALESCE((SELECT after.last_updated_ts FROM states AS after "
+            "WHERE after.state_id = :after_id), :after_ts)"
+        )
+        return [
+            f"(states.last_updated_ts < {after_ts} OR "
+            f"(states.last_updated_ts = {after_ts} "
+            "AND states.state_id < :after_id))"
+        ]
+
+    @staticmethod
+    def _watermark_bound(since_state_id, params) -> List[str]:
+        """Return the condition that only keeps states after a state_id."""
+        if since_state_id is None:
+            return []
+        params["since_state_id"] = int(since_state_id)
+        return ["states.state_id > :since_state_id"]
+
+    @staticmethod
+    def _where(conditions) -> str:
+        return "".join(f"\n        AND {condition}" for condition in conditions)
+
+    def _sensor_data_query(self, limit, start, end, after, params) -> str:
+        params["metadata_ids"] = self.resolve_metadata_ids(domains=("sensor",))
+        conditions = self._time_bounds(
+            "states.last_updated_ts", start, end, params
+        ) + self._keyset_bound(after, params)
+
+        query = f"""
+        SELECT states.state,
+            states.last_updated_ts,
+            states_meta.entity_id,
+            state_attributes.shared_attrs,
+            states.attributes_id,
+            states.state_id
+        FROM states
+        JOIN states_meta ON states.metadata_id = states_meta.metadata_id
+        LEFT JOIN state_attributes ON states.attributes_id = state_attributes.attributes_id
+        WHERE states.metadata_id IN :metadata_ids
+        AND states.state NOT IN ('unknown',
+                                'unavailable'){self._where(conditions)}
+        ORDER BY states.last_updated_ts DESC, states.state_id DESC
+        """
+
+        if limit is not None:
+            query += f"LIMIT {limit}"
+        return query
+
+    def _data_of_query(
+        self, sensors, limit, start, end, after, since_state_id, params
+    ) -> str:
+        params["metadata_ids"] = self.resolve_metadata_ids(sensors)
+        conditions = (
+            self._time_bounds("states.last_updated_ts", start, end, params)
+            + self._keyset_bound(after, params)
+            + self._watermark_bound(since_state_id, params)
+        )
+
+        query = f"""
+            SELECT states.state, states.last_updated_ts, states_meta.entity_id,
+                states.state_id
+            FROM states
+            JOIN states_meta
+            ON states.metadata_id = states_meta.metadata_id
+            WHERE 
+                states.metadata_id IN :metadata_ids
+            AND
+                states.state NOT IN ('unknown', 'unavailable'){self._where(conditions)}
+            ORDER BY states.last_updated_ts DESC, states.state_id DESC
+        """
+
+        if limit is not None:
+            query += f"LIMIT {limit}"
+        return query
+
+    def _tail_query(self, sensors, batch_size, since_state_id, params) -> str:
+        params["metadata_ids"] = self.resolve_metadata_ids(sensors)
+        conditions = self._watermark_bound(since_state_id, params)
+
+        return f"""
+            SELECT states.state, states.last_updated_ts, states_meta.entity_id,
+                states.state_id
+            FROM states
+            JOIN states_meta
+            ON states.metadata_id = states_meta.metadata_id
+            WHERE
+                states.metadata_id IN :metadata_ids
+            AND
+                states.state NOT IN ('unknown', 'unavailable'){self._where(conditions)}
+            ORDER BY states.state_id
+            LIMIT {int(batch_size)}
+        """
+
+    def _statistics_of_query(self, sensors, limit, start, end, params) -> str:
+        params["metadata_ids"] = self.resolve_statistics_metadata_ids(sensors)
+        conditions = self._time_bounds("statistics.start_ts", start, end, params)
+
+        query = f"""
+            SELECT
+                statistics.created_ts,
+                statistics.start_ts,
+                statistics.last_reset_ts,
+                statistics.mean,
+                statistics.max,
+                statistics.sum,
+                statistics.state,
+                statistics_meta.statistic_id,
+                statistics_meta.source,
+                statistics_meta.unit_of_measurement,
+                statistics_meta.has_mean,
+                statistics_meta.has_sum
+            FROM statistics
+            JOIN statistics_meta
+            ON statistics.metadata_id = statistics_meta.id
+            WHERE 
+                statistics.metadata_id IN :metadata_ids{self._where(conditions)}
+            ORDER BY statistics.created_ts DESC
+        """
+
+        if limit is not None:
+            query += f"LIMIT {limit}"
+        return query
+
+    def _dialect_sql(self, templates, **kwargs) -> str:
+        """Format the template of the database dialect."""
+        if self.db_type not in templates:
+            raise ValueError(
+                "This query is not supported for {} databases".format(self.db_type)
+            )
+        return templates[self.db_type].format(**kwargs)
+
+
+class HassDatabase(_QueryBuilder):
     """
     Initializing the parser fetches all of the data from the database and
     places it in a master pandas dataframe.
     """
 
-    def __init__(self, url, *, fetch_entities=True):
+    def __init__(
+        self,
+        url,
+        *,
+        fetch_entities=True,
+        backend="pandas",
+        pool_size=DEFAULT_POOL_SIZE,
+        read_only=False,
+        explain=False,
+        on_query=None,
+    ):
         """
         Parameters
         ----------
         url : str
             The URL to the database.
+        fetch_entities : bool
+            Fetch the entities with data when connecting.
+        backend : str
+            The type of frame fetches return: "pandas" for a pandas
+            DataFrame, "arrow" for a pyarrow Table or "polars" for a polars
+            DataFrame. With the adbc-driver-sqlite package installed, the
+            arrow and polars backends read full SQLite results straight into
+            Arrow buffers, about twice as fast as pandas. Other databases,
+            the iter_* methods and queries ADBC can't run are read through
+            SQLAlchemy and converted to Arrow ARROW_BATCH_SIZE rows at a
+            time, which keeps the peak memory of a load low.
+        pool_size : int
+            The number of connections kept open for reuse. Every query
+            checks out a connection from this pool and returns it when done.
+        read_only : bool
+            Open SQLite databases in read-only mode, so a database Home
+            Assistant is writing to can never be modified.
+        explain : bool
+            Capture the plan of every fetch query in its QueryStats, with
+            EXPLAIN QUERY PLAN on SQLite and EXPLAIN ANALYZE on PostgreSQL
+            and MySQL, which runs the query a second time.
+        on_query : callable
+            Called with the QueryStats of every query when it completes,
+            e.g. to send the timings to a metrics system.
+
+        Every query is logged to the `detective.core` logger at DEBUG
+        level: the SQL, its timings, size and plan. `stats()` summarizes
+        the last QUERY_HISTORY queries.
+
+        Use the database as a context manager, or call `close()`, to close
+        the pooled connections when done.
         """
-        self.url = url
-        self.entities = None
+        super().__init__(url, backend, explain, on_query)
+        self._adbc_uri = _adbc_uri(url, self.db_type, backend)
         try:
-            self.engine = create_engine(url)
-            print("Successfully connected to database", stripped_db_url(url))
-            self.con = self.engine.connect()
+            engine_url, options = _engine_arguments(
+                url, self.db_type, pool_size, read_only
+            )
+            self.engine = create_engine(engine_url, **options)
+            if self.db_type == "sqlite":
+                _register_sqlite_functions(self.engine)
+            with self.engine.connect():
+                pass
+            _LOGGER.info("Successfully connected to database %s", stripped_db_url(url))
             if fetch_entities:
                 self.fetch_entities()
         except Exception as exc:
@@ -64,21 +859,43 @@ class HassDatabase:
                     "missing. Please make sure that it is installed."
                 )
 
-            print(exc)
+            _LOGGER.error(exc)
             raise
 
-        self.db_type = get_db_type(url)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        """Close all pooled connections to the database."""
+        self.engine.dispose()
 
     def perform_query(self, query, **params):
-        """Perform a query."""
+        """
+        Perform a query.
+
+        The rows are fetched before the connection is returned to the pool,
+        so the result can be used after the call.
+        """
+        stats = QueryStats(str(query))
         try:
             if isinstance(query, str):
                 query = text(query)
             with self.engine.connect() as conn:
-                return conn.execute(query, params)
+                started = perf_counter()
+                result = conn.execute(query, params)
+                stats.execute = perf_counter() - started
+                started = perf_counter()
+                frozen = result.freeze()
+                stats.fetch = perf_counter() - started
+                stats.rows = len(frozen.data)
         except:
-            print(f"Error with query: {query}")
+            _LOGGER.error("Error with query: %s", query)
             raise
+        self._record(stats)
+        return frozen()
 
     def fetch_entities(self) -> None:
         """Fetch entities for which we have data."""
@@ -91,123 +908,806 @@ class HassDatabase:
 
         # Parse the domains from the entities.
         self.entities = [e[0] for e in response]
-        print(f"There are {len(self.entities)} entities with data")
+        _LOGGER.info("There are %d entities with data", len(self.entities))
+
+    def fetch_metadata_ids(self) -> Dict[str, int]:
+        """Fetch and cache the mapping of entity_id to states metadata_id."""
+        query = text(
+            """
+            SELECT entity_id, metadata_id FROM states_meta
+            """
+        )
+        response = self.perform_query(query)
+
+        self.metadata_ids = {
+            entity_id: metadata_id for entity_id, metadata_id in response
+        }
+        return self.metadata_ids
+
+    def fetch_statistics_metadata_ids(self) -> Dict[str, int]:
+        """Fetch and cache the mapping of statistic_id to statistics_meta id."""
+        query = text(
+            """
+            SELECT statistic_id, id FROM statistics_meta
+            """
+        )
+        response = self.perform_query(query)
+
+        self.statistics_metadata_ids = {
+            statistic_id: metadata_id for statistic_id, metadata_id in response
+        }
+        return self.statistics_metadata_ids
 
-    def fetch_all_sensor_data(self, limit=50000) -> pd.DataFrame:
+    def _frames(self, con, query, params, stats, chunksize=None) -> Iterator:
         """
-        Fetch data for all sensor entities.
+        Yield the result of a query as frames of the configured backend, in
+        chunks of `chunksize` rows or as a single frame if it is None, and
+        add the time spent and rows fetched to `stats`.
+        """
+        if chunksize is None and self.backend != "pandas":
+            table = self._adbc_table(query, params, stats)
+            if table is None:
+                table = self._read_arrow(con, query, params, stats)
+            started = perf_counter()
+            frame = _from_arrow(table, self.backend)
+            stats.build += perf_counter() - started
+            stats.rows += table.num_rows
+            yield frame
+            return
 
-        Arguments:
-        - limit (default: 50000): Limit the maximum number of state changes loaded.
-            If None, there is no limit.
-        - get_attributes: If True, LEFT JOIN the attributes table to retrieve event's attributes.
+        started = perf_counter()
+        result = con.execute(query, params)
+        stats.execute += perf_counter() - started
+        names = list(result.keys())
+
+        started = perf_counter()
+        if chunksize is None:
+            partitions = iter([result.fetchall()])
+        else:
+            partitions = result.partitions(chunksize)
+        stats.fetch += perf_counter() - started
+
+        empty = True
+        while True:
+            started = perf_counter()
+            rows = next(partitions, [] if empty else None)
+            stats.fetch += perf_counter() - started
+            if rows is None:
+                return
+            empty = False
+            started = perf_counter()
+            frame = _build_frame(names, rows, self.backend)
+            stats.build += perf_counter() - started
+            stats.rows += len(rows)
+            yield frame
+
+    @staticmethod
+    def _read_arrow(con, query, params, stats):
+        """
+        Read the result of a query into an Arrow table, converting the rows
+        ARROW_BATCH_SIZE at a time as they are fetched.
         """
+        started = perf_counter()
+        result = con.execute(query, params)
+        stats.execute += perf_counter() - started
+        names = list(result.keys())
 
-        query = """
-        SELECT states.state,
-            datetime(states.last_updated_ts, 'unixepoch', 'subsec') as last_updated_ts,
-            states_meta.entity_id,
-            state_attributes.shared_attrs
-        FROM states
-        JOIN states_meta ON states.metadata_id = states_meta.metadata_id
-        LEFT JOIN state_attributes ON states.attributes_id = state_attributes.attributes_id
-        WHERE states_meta.entity_id LIKE '%sensor%'
-        AND states.state NOT IN ('unknown',
-                                'unavailable')
-        ORDER BY last_updated_ts DESC
+        partitions = result.partitions(ARROW_BATCH_SIZE)
+        tables = []
+        while True:
+            started = perf_counter()
+            rows = next(partitions, None)
+            stats.fetch += perf_counter() - started
+            if rows is None:
+                break
+            started = perf_counter()
+            tables.append(_arrow_table(names, rows))
+            stats.build += perf_counter() - started
+        return _concat(tables, "arrow") if tables else _arrow_table(names, [])
+
+    def _adbc_table(self, query, params, stats):
         """
+        Read the result of a query straight into an Arrow table with the
+        ADBC SQLite driver, with list parameters expanded into the IN lists.
 
-        if limit is not None:
-            query += f"LIMIT {limit}"
-        print(query)
-        query = text(query)
-        df = pd.read_sql_query(query, con=self.con)
-        print(f"The returned Pandas dataframe has {df.shape[0]} rows of data.")
+        Returns None if the driver can't run the query, like queries using
+        the REGEXP function or with columns whose type changes after the
+        first rows, to fall back to reading the rows with SQLAlchemy.
+        """
+        if self._adbc_uri is None:
+            return None
+        from adbc_driver_sqlite import dbapi
+
+        compiled = query.bindparams(**params).compile(
+            dialect=self.engine.dialect, compile_kwargs={"render_postcompile": True}
+        )
+        values = [compiled.params[name] for name in compiled.positiontup]
+        try:
+            with dbapi.connect(self._adbc_uri) as adbc, adbc.cursor() as cursor:
+                started = perf_counter()
+                cursor.execute(compiled.string, values)
+                stats.execute += perf_counter() - started
+                started = perf_counter()
+                table = cursor.fetch_arrow_table()
+                stats.fetch += perf_counter() - started
+        except (dbapi.Error, OSError) as exc:
+            _LOGGER.debug("Reading with SQLAlchemy, ADBC failed: %s", exc)
+            return None
+        return table
+
+    def _explain(self, con, query, params) -> str:
+        """Return the plan of a query as text."""
+        rows = con.execute(self._explain_query(query, params), params).fetchall()
+        return self._format_plan(rows)
+
+    def _read_query(
+        self, query, params=None, order_by=None, limit=None, descending=True
+    ):
+        """
+        Run a query and load the full result into a frame.
+
+        Results of batched queries are merged, sorted on `order_by` if given
+        and cut to `limit` rows.
+        """
+        params = params or {}
+        _LOGGER.debug(query)
+        stats = QueryStats(query)
+        query = self._text(query, params)
+        with self.engine.connect() as con:
+            frames = [
+                frame
+                for batch in self._batched(params)
+                for frame in self._frames(con, query, batch, stats)
+            ]
+            if self.explain:
+                stats.plan = self._explain(con, query, next(self._batched(params)))
+
+        return self._merge(frames, stats, order_by, limit, descending)
+
+    def _iter_query(self, query, chunksize, params=None, limit=None) -> Iterator:
+        """
+        Run a query and yield the result as frames of at most
+        `chunksize` rows, streaming them from a server side cursor.
+
+        Batched queries are streamed one batch after the other, so rows are
+        only ordered within a batch, and stop after `limit` rows in total.
+        The stats of the query are recorded once it is exhausted or closed.
+        """
+        params = params or {}
+        _LOGGER.debug(query)
+        stats = QueryStats(query)
+        query = self._text(query, params)
+        try:
+            with self.engine.connect() as con:
+                con = con.execution_options(stream_results=True)
+                for batch in self._batched(params):
+                    for frame in self._frames(con, query, batch, stats, chunksize):
+                        frame = _limit_frame(frame, stats, limit, self.backend)
+                        stats.bytes += _nbytes(frame, self.backend)
+                        yield frame
+                        if limit is not None and stats.rows >= limit:
+                            return
+        finally:
+            self._record(stats)
+
+    def fetch_all_sensor_data(
+        self, limit=50000, start=None, end=None, after=None, attributes=None
+    ) -> pd.DataFrame:
+        """
+        Fetch data for all sensor entities, with last_updated_ts as naive
+        UTC datetimes.
+
+        Arguments:
+        - limit (default: 50000): Limit the maximum number of state changes loaded.
+            If None, there is no limit.
+        - start, end (default: None): Only load state changes with
+            start <= last_updated_ts < end. Datetimes, ISO strings or epoch
+            timestamps are accepted, naive datetimes are treated as UTC.
+        - after (default: None): A (last_updated_ts, state_id) tuple, taken
+            from the last row of a previous page, to resume after.
+        - attributes (default: None): Attribute keys, e.g.
+            `functions.DEFAULT_ATTRIBUTES`, to decode from shared_attrs into
+            typed columns. Each distinct attributes blob is decoded once.
+        """
+        params = {}
+        query = self._sensor_data_query(limit, start, end, after, params)
+        df = self._read_query(query, params, STATES_ORDER, limit)
+        df = _epoch_to_datetime(df, "last_updated_ts", self.backend)
+        if attributes:
+            df = self._expand_attributes(df, attributes)
         return df
 
-    def fetch_all_data_of(self, sensors: Tuple[str], limit=50000) -> pd.DataFrame:
+    def fetch_all_data_of(
+        self,
+        sensors: Tuple[str],
+        limit=50000,
+        start=None,
+        end=None,
+        after=None,
+        since_state_id=None,
+    ) -> pd.DataFrame:
         """
         Fetch data for sensors.
 
         Arguments:
+        - sensors: entity_ids or glob patterns such as `sensor.*_power`.
         - limit (default: 50000): Limit the maximum number of state changes loaded.
             If None, there is no limit.
-        - get_attributes: If True, LEFT JOIN the attributes table to retrieve event's attributes.
+        - start, end (default: None): Only load state changes with
+            start <= last_updated_ts < end.
+        - after (default: None): A (last_updated_ts, state_id) tuple, taken
+            from the last row of a previous page, to resume after. This pages
+            through deep history without OFFSET scans:
+
+            page = db.fetch_all_data_of(sensors, limit=1000)
+            last = page.iloc[-1]
+            page = db.fetch_all_data_of(
+                sensors, limit=1000, after=(last.last_updated_ts, last.state_id)
+            )
+        - since_state_id (default: None): Only load states with a state_id
+            above this high-water mark, i.e. rows recorded since a previous
+            fetch.
+        """
+        params = {}
+        query = self._data_of_query(
+            sensors, limit, start, end, after, since_state_id, params
+        )
+        return self._read_query(query, params, STATES_ORDER, limit)
+
+    def fetch_many(
+        self,
+        sensors: Tuple[str],
+        start=None,
+        end=None,
+        workers=DEFAULT_POOL_SIZE,
+        period=None,
+    ) -> pd.DataFrame:
         """
-        sensors_str = str(tuple(sensors))
-        if len(sensors) == 1:
-            sensors_str = sensors_str.replace(",", "")
+        Fetch the data of many sensors in parallel.
+
+        The work is split in one shard per entity, or per entity and
+        `period` of time, which run on a pool of `workers` threads. Every
+        shard runs on its own pooled connection, so the pool_size of the
+        database should be at least `workers`. The shards are concatenated
+        in entity order, newest first within an entity, like
+        fetch_all_data_of.
+
+        Arguments:
+        - sensors: entity_ids or glob patterns such as `sensor.*_power`.
+        - start, end (default: None): Only load state changes with
+            start <= last_updated_ts < end.
+        - workers (default: 5): Number of shards fetched concurrently.
+        - period (default: None): Split the time range of every entity in
+            shards of this length, e.g. "7D". Requires start and end.
+        """
+        # Resolve once, so the workers only read the cached metadata_ids.
+        entities = self.resolve_entities(sensors)
+        ranges = [(start, end)]
+        if period is not None:
+            if start is None or end is None:
+                raise ValueError("Sharding by period requires a start and end")
+            ranges = _time_shards(start, end, period)
+
+        shards = [
+            ((entity,), shard_start, shard_end)
+            for entity in entities
+            for shard_start, shard_end in ranges
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            frames = list(
+                executor.map(
+                    lambda shard: self.fetch_all_data_of(
+                        shard[0], limit=None, start=shard[1], end=shard[2]
+                    ),
+                    shards,
+                )
+            )
+
+        if not frames:
+            return self.fetch_all_data_of((), limit=None)
+        return _concat(frames, self.backend)
+
+    def fetch_aggregated(
+        self,
+        sensors: Tuple[str],
+        bucket="5min",
+        aggs=("mean", "min", "max", "last"),
+        start=None,
+        end=None,
+        wide=False,
+    ) -> pd.DataFrame:
+        """
+        Fetch numeric states aggregated per entity and time bucket, computed
+        inside the database.
+
+        Returns a long frame with an entity_id, the bucket start as naive UTC
+        datetime and a column per aggregate, ordered by entity and bucket.
+        Non-numeric states are skipped.
+
+        Arguments:
+        - sensors: entity_ids or glob patterns such as `sensor.*_power`.
+        - bucket (default: "5min"): Length of the time buckets, a pandas
+            timedelta string or a number of seconds.
+        - aggs (default: mean, min, max, last): Aggregates to compute, any of
+            mean, min, max, sum, count, first and last.
+        - start, end (default: None): Only aggregate state changes with
+            start <= last_updated_ts < end.
+        - wide (default: False): Return a pandas DataFrame indexed by bucket
+            with a column per aggregate and entity instead.
+        """
+        unknown = set(aggs) - set(AGGREGATES)
+        if unknown:
+            raise ValueError("Unknown aggregates {}".format(sorted(unknown)))
+
+        self._require_metadata_ids()
+        params = {
+            # Ordered by entity_id, so batches come back in entity order.
+            "metadata_ids": [
+                self.metadata_ids[entity] for entity in self.resolve_entities(sensors)
+            ],
+            "bucket": _seconds(bucket),
+        }
+        conditions = [
+            self._dialect_sql(NUMERIC_SQL, column="states.state")
+        ] + self._time_bounds("states.last_updated_ts", start, end, params)
+        bucket_sql = self._dialect_sql(BUCKET_SQL, column="states.last_updated_ts")
+        value_sql = self._dialect_sql(FLOAT_SQL, column="states.state")
+
+        ranks = ""
+        for rank, direction in (("first", "ASC"), ("last", "DESC")):
+            if rank in aggs:
+                ranks += f""",
+                    ROW_NUMBER() OVER (
+                        PARTITION BY states.metadata_id, {bucket_sql}
+                        ORDER BY states.last_updated_ts {direction},
+                            states.state_id {direction}
+                    ) AS {rank}_rank"""
+        columns = "".join(
+            f",\n                {AGGREGATES[agg]} AS {agg}" for agg in aggs
+        )
 
         query = f"""
-            WITH combined_states AS (
-                SELECT states.state, states.last_updated_ts, states_meta.entity_id
+            WITH bucketed AS (
+                SELECT
+                    states.metadata_id,
+                    {bucket_sql} AS bucket,
+                    {value_sql} AS value{ranks}
                 FROM states
-                JOIN states_meta
-                ON states.metadata_id = states_meta.metadata_id
+                WHERE
+                    states.metadata_id IN :metadata_ids{self._where(conditions)}
             )
-            SELECT *
-            FROM combined_states
-            WHERE 
-                entity_id IN {sensors_str}
-            AND
-                state NOT IN ('unknown', 'unavailable')
-            ORDER BY last_updated_ts DESC
+            SELECT
+                states_meta.entity_id,
+                bucketed.bucket{columns}
+            FROM bucketed
+            JOIN states_meta
+            ON bucketed.metadata_id = states_meta.metadata_id
+            GROUP BY states_meta.entity_id, bucketed.bucket
+            ORDER BY states_meta.entity_id, bucketed.bucket
         """
+        df = self._read_query(query, params)
+        df = _epoch_to_datetime(df, "bucket", self.backend)
 
-        if limit is not None:
-            query += f"LIMIT {limit}"
-        print(query)
-        query = text(query)
-        df = pd.read_sql_query(query, con=self.con)
-        print(f"The returned Pandas dataframe has {df.shape[0]} rows of data.")
+        if wide:
+            df = _to_pandas(df, self.backend).pivot(
+                index="bucket", columns="entity_id", values=list(aggs)
+            )
         return df
 
-    def fetch_all_statistics_of(self, sensors: Tuple[str], limit=50000) -> pd.DataFrame:
+    def _fetch_aggregated_statistics(
+        self, table, sensors, bucket, aggs, start, end
+    ) -> pd.DataFrame:
+        """Aggregate a statistics table in buckets, like fetch_aggregated."""
+        params = {
+            "metadata_ids": self.resolve_statistics_metadata_ids(sensors),
+            "bucket": bucket,
+        }
+        conditions = self._time_bounds(f"{table}.start_ts", start, end, params)
+        bucket_sql = self._dialect_sql(BUCKET_SQL, column=f"{table}.start_ts")
+        columns = "".join(
+            ",\n                {} AS {}".format(
+                STATISTICS_AGGREGATES[agg].format(table=table), agg
+            )
+            for agg in aggs
+        )
+
+        query = f"""
+            SELECT
+                statistics_meta.statistic_id AS entity_id,
+                {bucket_sql} AS bucket{columns}
+            FROM {table}
+            JOIN statistics_meta
+            ON {table}.metadata_id = statistics_meta.id
+            WHERE
+                {table}.metadata_id IN :metadata_ids{self._where(conditions)}
+            GROUP BY statistics_meta.statistic_id, {bucket_sql}
+            ORDER BY statistics_meta.statistic_id, {bucket_sql}
+        """
+        df = self._read_query(query, params)
+        return _epoch_to_datetime(df, "bucket", self.backend)
+
+    def _statistics_spans(self, table, sensors, period) -> Dict[str, tuple]:
+        """
+        Return the period covered by a statistics table for each of the
+        sensors with statistics in it: the start of its first row and the
+        end of its last row. Only rows with a mean count, the statistics of
+        sensors like total_increasing energy meters only have a sum.
+        """
+        params = {"metadata_ids": self.resolve_statistics_metadata_ids(sensors)}
+        if not params["metadata_ids"]:
+            return {}
+        query = self._text(
+            f"""
+            SELECT statistics_meta.statistic_id,
+                MIN({table}.start_ts), MAX({table}.start_ts)
+            FROM {table}
+            JOIN statistics_meta
+            ON {table}.metadata_id = statistics_meta.id
+            WHERE {table}.metadata_id IN :metadata_ids
+            AND {table}.mean IS NOT NULL
+            GROUP BY statistics_meta.statistic_id
+            """,
+            params,
+        )
+        return {
+            statistic_id: (first_start, last_start + period)
+            for statistic_id, first_start, last_start in self.perform_query(
+                query, **params
+            )
+        }
+
+    def fetch_series(
+        self,
+        sensors: Tuple[str],
+        bucket="1h",
+        aggs=("mean", "min", "max"),
+        start=None,
+        end=None,
+    ) -> pd.DataFrame:
+        """
+        Fetch aggregated series for sensors from the cheapest source.
+
+        Raw states are purged after the recorder's keep_days, while the
+        long-term statistics keep hourly (statistics) and 5 minute
+        (statistics_short_term) aggregates of sensors with a state_class.
+        For every entity, each bucket is read from the coarsest table whose
+        period divides the bucket and that covers it, so a series of hourly
+        buckets over years reads one row per entity per hour. Buckets the
+        statistics of an entity don't cover, like the current hour, those
+        before its first statistics or all of them for entities without a
+        state_class or with only a sum, are aggregated from the states. The
+        parts are stitched into one frame in the layout of fetch_aggregated.
+
+        Arguments:
+        - sensors: entity_ids or glob patterns such as `sensor.*_power`.
+        - bucket (default: "1h"): Length of the time buckets, a pandas
+            timedelta string or a number of seconds.
+        - aggs (default: mean, min, max): Aggregates to compute, any of mean,
+            min and max.
+        - start, end (default: None): Only aggregate buckets with
+            start <= bucket < end.
+        """
+        unknown = set(aggs) - set(STATISTICS_AGGREGATES)
+        if unknown:
+            raise ValueError("Unknown aggregates {}".format(sorted(unknown)))
+
+        bucket = _seconds(bucket)
+        lower = -math.inf if start is None else time.to_timestamp(start)
+        upper = math.inf if end is None else time.to_timestamp(end)
+
+        # The time ranges of every entity not read from a source yet.
+        spans = {
+            table: self._statistics_spans(table, sensors, period)
+            for table, period in STATISTICS_TABLES
+            if bucket % period == 0
+        }
+        entities = set(self.resolve_entities(sensors))
+        for table_spans in spans.values():
+            entities.update(table_spans)
+        remaining = {entity: [(lower, upper)] for entity in entities}
+
+        # Entities are read together when they share a source and range.
+        sources: Dict[tuple, list] = {}
+        for table, table_spans in spans.items():
+            for entity, (first_start, last_end) in table_spans.items():
+                # Only whole buckets are read from a table.
+                covered = (
+                    math.ceil(first_start / bucket) * bucket,
+                    last_end // bucket * bucket,
+                )
+                ranges, remaining[entity] = _split_ranges(
+                    remaining[entity], *covered
+                )
+                for lo, hi in ranges:
+                    sources.setdefault((table, lo, hi), []).append(entity)
+        for entity, ranges in remaining.items():
+            for lo, hi in ranges:
+                sources.setdefault(("states", lo, hi), []).append(entity)
+
+        frames = []
+        for (table, lo, hi), group in sorted(sources.items()):
+            lo = None if lo == -math.inf else lo
+            hi = None if hi == math.inf else hi
+            _LOGGER.debug("Reading %s to %s from %s for %s", lo, hi, table, group)
+            if table == "states":
+                frame = self.fetch_aggregated(group, bucket, aggs, start=lo, end=hi)
+            else:
+                frame = self._fetch_aggregated_statistics(
+                    table, group, bucket, aggs, lo, hi
+                )
+            frames.append(frame)
+        if not frames:
+            frames.append(self.fetch_aggregated((), bucket, aggs))
+        df = _concat(frames, self.backend)
+        return _sort(df, ["entity_id", "bucket"], self.backend)
+
+    def _grid(self, start, end, freq, anchor) -> np.ndarray:
+        """Return the epoch timestamps of the grid of fetch_matrix."""
+        import numpy as np
+
+        if anchor is not None:
+            df = self.fetch_all_data_of((anchor,), limit=None, start=start, end=end)
+            times = _to_pandas(df, self.backend)["last_updated_ts"].to_numpy()
+            return np.unique(times.astype("float64"))
+        if start is None or end is None:
+            raise ValueError("A grid with a frequency requires a start and end")
+        start, end = time.to_timestamp(start), time.to_timestamp(end)
+        return np.arange(start, end, _seconds(freq))
+
+    def fetch_matrix(
+        self, sensors: Tuple[str], start=None, end=None, freq="1min", anchor=None
+    ) -> pd.DataFrame:
+        """
+        Fetch numeric states of many entities aligned on a shared time grid.
+
+        Returns a dense float32 pandas DataFrame indexed by the grid times as
+        naive UTC datetimes, with a column per entity holding its last
+        numeric state at or before each time (an as-of join with forward
+        fill), NaN before its first state. The last state before `start`
+        is included, so the first rows are filled too. Entities are read
+        one at a time, ordered on the metadata_id and last_updated_ts
+        index, and written straight into the matrix, so memory is the
+        matrix plus the states of one entity.
+
+        Arguments:
+        - sensors: entity_ids or glob patterns such as `sensor.*_power`.
+        - start, end (default: None): The grid covers start <= time < end.
+        - freq (default: "1min"): Spacing of the grid, a pandas timedelta
+            string or a number of seconds.
+        - anchor (default: None): An entity_id whose state changes between
+            start and end form the grid instead, e.g. to sample every sensor
+            whenever the HVAC power changes.
+        """
+        import numpy as np
+        import pandas as pd
+
+        from . import functions
+
+        grid = self._grid(start, end, freq, anchor)
+        entities = self.resolve_entities(sensors)
+        self._require_metadata_ids()
+
+        numeric_sql = self._dialect_sql(NUMERIC_SQL, column="states.state")
+        previous_sql = self._dialect_sql(NUMERIC_SQL, column="previous.state")
+        value_sql = self._dialect_sql(FLOAT_SQL, column="states.state")
+        query = f"""
+            SELECT states.last_updated_ts, {value_sql} AS value
+            FROM states
+            WHERE
+                states.metadata_id = :metadata_id
+            AND
+                {numeric_sql}
+            AND
+                states.last_updated_ts >= COALESCE((
+                    SELECT MAX(previous.last_updated_ts)
+                    FROM states AS previous
+                    WHERE previous.metadata_id = :metadata_id
+                    AND previous.last_updated_ts <= :first
+                    AND {previous_sql}
+                ), :first)
+            AND
+                states.last_updated_ts <= :last
+            ORDER BY states.last_updated_ts, states.state_id
+        """
+        _LOGGER.debug(query)
+        stats = QueryStats(query)
+        query = text(query)
+
+        matrix = np.full((len(grid), len(entities)), np.nan, dtype="float32")
+        if len(grid):
+            params = {"first": float(grid[0]), "last": float(grid[-1])}
+            with self.engine.connect() as con:
+                for j, entity in enumerate(entities):
+                    params["metadata_id"] = self.metadata_ids[entity]
+                    started = perf_counter()
+                    result = con.execute(query, params)
+                    stats.execute += perf_counter() - started
+                    started = perf_counter()
+                    rows = result.fetchall()
+                    stats.fetch += perf_counter() - started
+                    started = perf_counter()
+                    states = np.array(rows, dtype="float64").reshape(-1, 2)
+                    functions.asof_fill(
+                        states[:, 0], states[:, 1], grid, out=matrix[:, j]
+                    )
+                    stats.build += perf_counter() - started
+                    stats.rows += len(rows)
+                if self.explain and entities:
+                    stats.plan = self._explain(con, query, params)
+
+        stats.bytes = matrix.nbytes
+        self._record(stats)
+        index = pd.to_datetime(grid, unit="s").as_unit("ms")
+        return pd.DataFrame(matrix, index=index, columns=entities, copy=False)
+
+    def fetch_all_statistics_of(
+        self, sensors: Tuple[str], limit=50000, start=None, end=None
+    ) -> pd.DataFrame:
         """
         Fetch aggregated statistics for sensors.
 
         Arguments:
         - limit (default: 50000): Limit the maximum number of state changes loaded.
             If None, there is no limit.
+        - start, end (default: None): Only load statistics with
+            start <= start_ts < end.
         """
-        # Statistics imported from an external source are similar to entity_id,
-        # but use a : instead of a . as a delimiter between the domain and object ID.
-        sensors_with_semicolons = [sensor.replace(".", ":") for sensor in sensors]
-        sensors_combined = list(sensors) + sensors_with_semicolons
-        sensors_str = str(tuple(sensors_combined))
-        if len(sensors_combined) == 1:
-            sensors_str = sensors_str.replace(",", "")
+        params = {}
+        query = self._statistics_of_query(sensors, limit, start, end, params)
+        return self._read_query(query, params, STATISTICS_ORDER, limit)
 
-        query = f"""
-            WITH combined_states AS (
-                SELECT
-                    statistics.created_ts,
-                    statistics.start_ts,
-                    statistics.last_reset_ts,
-                    statistics.mean,
-                    statistics.max,
-                    statistics.sum,
-                    statistics.state,
-                    statistics_meta.statistic_id,
-                    statistics_meta.source,
-                    statistics_meta.unit_of_measurement,
-                    statistics_meta.has_mean,
-                    statistics_meta.has_sum
-                FROM statistics
-                JOIN statistics_meta
-                ON statistics.metadata_id = statistics_meta.id
+    def iter_all_sensor_data(
+        self,
+        chunksize=DEFAULT_CHUNKSIZE,
+        limit=None,
+        start=None,
+        end=None,
+        attributes=None,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Stream data for all sensor entities as dataframes of `chunksize` rows.
+
+        Only one chunk is held in memory at a time, so this can be used to
+        process the full history of a large database.
+
+        Arguments:
+        - chunksize (default: 10000): Maximum number of rows per dataframe.
+        - limit (default: None): Limit the maximum number of state changes loaded.
+            If None, there is no limit.
+        - start, end (default: None): Only load state changes with
+            start <= last_updated_ts < end.
+        - attributes (default: None): Attribute keys to decode from
+            shared_attrs into typed columns.
+        """
+        params = {}
+        query = self._sensor_data_query(limit, start, end, None, params)
+        chunks = (
+            _epoch_to_datetime(chunk, "last_updated_ts", self.backend)
+            for chunk in self._iter_query(query, chunksize, params, limit)
+        )
+        if attributes:
+            chunks = (self._expand_attributes(c, attributes) for c in chunks)
+        return chunks
+
+    def iter_all_data_of(
+        self,
+        sensors: Tuple[str],
+        chunksize=DEFAULT_CHUNKSIZE,
+        limit=None,
+        start=None,
+        end=None,
+        since_state_id=None,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Stream data for sensors as dataframes of `chunksize` rows.
+
+        Arguments:
+        - chunksize (default: 10000): Maximum number of rows per dataframe.
+        - limit (default: None): Limit the maximum number of state changes loaded.
+            If None, there is no limit.
+        - start, end (default: None): Only load state changes with
+            start <= last_updated_ts < end.
+        - since_state_id (default: None): Only load states with a state_id
+            above this high-water mark.
+        """
+        params = {}
+        query = self._data_of_query(
+            sensors, limit, start, end, None, since_state_id, params
+        )
+        return self._iter_query(query, chunksize, params, limit)
+
+    def tail(
+        self,
+        sensors: Tuple[str],
+        since_state_id=None,
+        batch_size=1000,
+        poll_interval=1.0,
+        max_interval=60.0,
+        watermark_path=None,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Follow the states recorded for sensors, polling the database forever
+        and yielding the new rows as dataframes of at most `batch_size` rows
+        in state_id order, with the columns of fetch_all_data_of.
+
+        Every poll reads the rows above a watermark, the largest state_id
+        yielded so far, from the primary key index, so each poll only does
+        work proportional to the rows recorded since the previous one:
+
+            for batch in db.tail(("sensor.*_power",), watermark_path="w.json"):
+                update_model(batch)
+
+        Arguments:
+        - sensors: entity_ids or glob patterns such as `sensor.*_power`,
+            resolved on every poll, so entities recorded for the first time
+            while tailing are followed too.
+        - since_state_id (default: None): Only yield states with a state_id
+            above this watermark. If None, tailing resumes from the
+            watermark file, or starts at the latest state.
+        - batch_size (default: 1000): Maximum number of rows per dataframe.
+            Full batches are followed by the next poll right away.
+        - poll_interval (default: 1.0): Seconds to wait for new rows after
+            a partial batch. Every poll that finds no rows doubles the wait,
+            up to `max_interval` (default: 60.0) seconds.
+        - watermark_path (default: None): JSON file to persist the
+            watermark in. It is written once the consumer asks for the next
+            batch, so a restarted job gets every row at least once.
+        """
+        if since_state_id is None and watermark_path is not None:
+            if os.path.exists(watermark_path):
+                with open(watermark_path) as fp:
+                    since_state_id = json.load(fp)["since_state_id"]
+        if since_state_id is None:
+            latest = self.perform_query("SELECT MAX(state_id) FROM states").scalar()
+            since_state_id = latest or 0
+
+        interval = poll_interval
+        entities_stamp = None
+        while True:
+            # New entities get a new, larger metadata_id in states_meta.
+            stamp = tuple(
+                self.perform_query(
+                    "SELECT COUNT(*), MAX(metadata_id) FROM states_meta"
+                ).one()
             )
-            SELECT *
-            FROM combined_states
-            WHERE 
-                statistic_id IN {sensors_str}
-            ORDER BY created_ts DESC
+            if stamp != entities_stamp:
+                self.fetch_metadata_ids()
+                entities_stamp = stamp
+            params = {}
+            query = self._tail_query(sensors, batch_size, since_state_id, params)
+            batch = self._read_query(
+                query, params, ["state_id"], batch_size, descending=False
+            )
+            if len(batch):
+                yield batch
+                since_state_id = _last(batch, "state_id", self.backend)
+                if watermark_path is not None:
+                    _save_watermark(watermark_path, since_state_id)
+                interval = poll_interval
+                if len(batch) == batch_size:
+                    continue
+            sleep(interval)
+            if not len(batch):
+                interval = min(interval * 2, max_interval)
+
+    def iter_all_statistics_of(
+        self,
+        sensors: Tuple[str],
+        chunksize=DEFAULT_CHUNKSIZE,
+        limit=None,
+        start=None,
+        end=None,
+    ) -> Iterator[pd.DataFrame]:
         """
+        Stream aggregated statistics for sensors as dataframes of `chunksize` rows.
 
-        if limit is not None:
-            query += f"LIMIT {limit}"
-        print(query)
-        query = text(query)
-        df = pd.read_sql_query(query, con=self.con)
-        print(f"The returned Pandas dataframe has {df.shape[0]} rows of data.")
-        return df
+        Arguments:
+        - chunksize (default: 10000): Maximum number of rows per dataframe.
+        - limit (default: None): Limit the maximum number of statistics loaded.
+            If None, there is no limit.
+        - start, end (default: None): Only load statistics with
+            start <= start_ts < end.
+        """
+        params = {}
+        query = self._statistics_of_query(sensors, limit, start, end, params)
+        return self._iter_query(query, chunksize, params, limit)
@@ -4,16 +4,484 @@ Helper functions.
 
 import json
 
+import numpy as np
 import pandas as pd
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
-def format_dataframe(df: pd.DataFrame) -> pd.DataFrame:
-    """Convert states to numeric where possible and format the last_updated_ts."""
-    df["state"] = pd.to_numeric(df["state"], errors="coerce")
+# Attributes expand_attributes turns into columns by default.
+DEFAULT_ATTRIBUTES = (
+    "unit_of_measurement",
+    "device_class",
+    "state_class",
+    "friendly_name",
+)
 
-    df["last_updated_ts"] = pd.to_datetime(
-        df["last_updated_ts"], unit="s", utc=True
-    ).dt.tz_convert(None)
 
-    df = df.dropna()
+def format_dataframe(
+    df: pd.DataFrame,
+    *,
+    numeric=True,
+    float_dtype="float64",
+    categorical=False,
+    timestamps="datetime",
+    dropna=("state", "last_updated_ts"),
+    inplace=False,
+) -> pd.DataFrame:
+    """
+    Convert states to numeric where possible and format the last_updated_ts.
+
+    Arguments:
+    - numeric (default: True): Convert states to numbers, non-numeric
+        states become NaN. If False, states are stored as a category.
+    - float_dtype (default: "float64"): dtype of numeric states, "float32"
+        halves their memory.
+    - categorical (default: False): Store entity_id as a category.
+    - timestamps (default: "datetime"): Store last_updated_ts as naive UTC
+        datetimes at full precision ("datetime"), as datetime64[ms]
+        ("datetime_ms") or as int64 epoch milliseconds ("epoch").
+    - dropna (default: state and last_updated_ts): Columns in which a
+        missing value drops the row. None checks every column.
+    - inplace (default: False): Convert the columns of `df` itself instead
+        of a shallow copy, without copying the untouched columns either way.
+    """
+    if timestamps not in ("datetime", "datetime_ms", "epoch"):
+        raise ValueError("timestamps must be 'datetime', 'datetime_ms' or 'epoch'")
+    if not inplace:
+        df = df.copy(deep=False)
+
+    if numeric:
+        df["state"] = pd.to_numeric(df["state"], errors="coerce").astype(float_dtype)
+    else:
+        df["state"] = df["state"].astype("category")
+    if categorical and "entity_id" in df:
+        df["entity_id"] = df["entity_id"].astype("category")
+
+    columns = df.columns if dropna is None else [c for c in dropna if c in df]
+    missing = df[columns].isna().any(axis=1).to_numpy()
+    if missing.any():
+        if inplace:
+            # Drop by position, the labels of concatenated chunks repeat.
+            index = df.index[~missing]
+            df.reset_index(drop=True, inplace=True)
+            df.drop(index=np.flatnonzero(missing), inplace=True)
+            df.index = index
+        else:
+            df = df.take(np.flatnonzero(~missing))
+
+    last_updated = df["last_updated_ts"]
+    if not pd.api.types.is_datetime64_any_dtype(last_updated):
+        last_updated = pd.to_datetime(last_updated, unit="s")
+    elif last_updated.dt.tz is not None:
+        last_updated = last_updated.dt.tz_convert(None)
+    if timestamps != "datetime":
+        last_updated = last_updated.astype("datetime64[ms]")
+    if timestamps == "epoch":
+        last_updated = last_updated.astype("int64")
+    df["last_updated_ts"] = last_updated
+
     return df
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _attribute_column(values, codes) -> pd.Series:
+    """Build a typed column from the decoded `values` taken at `codes`."""
+    if any(isinstance(value, (dict, list)) for value in values):
+        column = np.array(values + [None], dtype=object)
+        return pd.Series(column[codes], dtype=object)
+
+    if all(value is None or _is_number(value) for value in values):
+        column = np.array(values + [None], dtype="float64")
+        return pd.Series(column[codes])
+
+    categorical = pd.Categorical(values)
+    category_codes = np.append(categorical.codes, -1)
+    return pd.Series(
+        pd.Categorical.from_codes(category_codes[codes], categorical.categories)
+    )
+
+
+def expand_attributes(
+    df: pd.DataFrame, keys=DEFAULT_ATTRIBUTES, column="shared_attrs"
+) -> pd.DataFrame:
+    """
+    Decode the JSON attributes in `column` and add `keys` as typed columns.
+
+    The recorder deduplicates attributes, so each distinct blob (keyed on
+    attributes_id when available) is only decoded once and the attribute
+    values are joined back to the rows. Numeric attributes become float
+    columns, others categorical.
+    """
+    key = "attributes_id" if "attributes_id" in df else column
+    # Missing attributes get code -1, which indexes the trailing NaN/None.
+    codes, uniques = pd.factorize(df[key])
+
+    if key == column:
+        blobs = uniques
+    else:
+        unique_codes, first_rows = np.unique(codes, return_index=True)
+        blobs = df[column].to_numpy()[first_rows[unique_codes >= 0]]
+
+    decoded = [json_loads(blob) if isinstance(blob, str) else {} for blob in blobs]
+
+    df = df.copy()
+    for attribute in keys:
+        values = [attributes.get(attribute) for attributes in decoded]
+        df[attribute] = _attribute_column(values, codes).set_axis(df.index)
+    return df
+
+
+def asof_fill(times, values, grid, out=None) -> np.ndarray:
+    """
+    Sample a series at `grid` with an as-of join: every grid point takes
+    the last of `values` at or before it, NaN before the first one.
+
+    `times` must be sorted ascending and in the same unit as `grid`, e.g.
+    both epoch seconds. The result is written into `out`, which may be a
+    column of a preallocated matrix, or a new float32 array.
+    """
+    if out is None:
+        out = np.empty(len(grid), dtype="float32")
+    positions = np.searchsorted(times, grid, side="right") - 1
+    if len(values):
+        out[:] = np.asarray(values)[np.maximum(positions, 0)]
+    out[positions < 0] = np.nan
+    return out
+
+
+def asof_matrix(df: pd.DataFrame, grid, columns=None) -> pd.DataFrame:
+    """
+    Align the states of many entities on a shared time grid.
+
+    Builds a dense float32 frame indexed by `grid`, a DatetimeIndex of naive
+    UTC times, with a column per entity holding its last numeric state at
+    or before each grid time. Non-numeric states are skipped. The matrix is
+    filled one entity at a time, without pivoting the states.
+
+    Arguments:
+    - df: States with entity_id, state and last_updated_ts columns, e.g.
+        from fetch_all_data_of.
+    - grid: The times to sample at, e.g. `pd.date_range(start, end,
+        freq="1min")`.
+    - columns (default: None): The entities to include, in order. By
+        default all entities in `df`, sorted.
+    """
+    grid = pd.DatetimeIndex(grid)
+    grid_ms = grid.as_unit("ms").asi8
+    values = pd.to_numeric(df["state"], errors="coerce").to_numpy("float64")
+    last_updated = df["last_updated_ts"]
+    if pd.api.types.is_datetime64_any_dtype(last_updated):
+        times = last_updated.astype("datetime64[ms]").to_numpy().view("int64")
+    else:
+        times = np.round(last_updated.to_numpy("float64") * 1000).astype("int64")
+
+    keep = ~np.isnan(values)
+    codes, entities = pd.factorize(df["entity_id"].to_numpy()[keep], sort=True)
+    times, values = times[keep], values[keep]
+    order = np.lexsort((times, codes))
+    codes, times, values = codes[order], times[order], values[order]
+    bounds = np.searchsorted(codes, np.arange(len(entities) + 1))
+    positions = {entity: i for i, entity in enumerate(entities)}
+
+    columns = list(entities) if columns is None else list(columns)
+    matrix = np.full((len(grid), len(columns)), np.nan, dtype="float32")
+    for j, entity in enumerate(columns):
+        if entity in positions:
+            i = positions[entity]
+            span = slice(bounds[i], bounds[i + 1])
+            asof_fill(times[span], values[span], grid_ms, out=matrix[:, j])
+    return pd.DataFrame(matrix, index=grid, columns=columns, copy=False)
+
+
+def _group_ranks(ids) -> np.ndarray:
+    """Return the position of every row among the earlier rows with its id."""
+    order = np.argsort(ids, kind="stable")
+    sorted_ids = ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    lengths = np.diff(np.r_[starts, len(ids)])
+    ranks = np.empty(len(ids), dtype="int64")
+    ranks[order] = np.arange(len(ids)) - np.repeat(starts, lengths)
+    return ranks
+
+
+class OnlineStats:
+    """
+    Running statistics of the numeric states of many entities, updated one
+    batch of new states at a time instead of over full windows, e.g. with
+    the batches of HassDatabase.tail.
+
+    For every entity it keeps the count, mean and variance (Welford's
+    algorithm, with batches merged like Chan et al.), an exponentially
+    weighted moving average and P² estimates of `quantiles`, in NumPy
+    arrays indexed by metadata_id. An update costs O(new rows): the mean,
+    variance and EWMA are vectorized over the whole batch, the quantiles
+    over all entities at once, one pass per state of the busiest entity.
+
+        stats = OnlineStats()
+        for batch in db.tail(("sensor.*",)):
+            scores = stats.update_frame(batch, db.metadata_ids)
+            outliers = batch[scores.abs() > 4]
+    """
+
+    # Markers of the P² algorithm: their heights, positions and desired
+    # positions, the latter two counted from 1.
+    _ARRAYS = ("count", "mean", "m2", "ewma", "heights", "positions", "desired")
+
+    def __init__(self, quantiles=(0.5, 0.9, 0.99), alpha=0.1):
+        """
+        Parameters
+        ----------
+        quantiles : sequence of float
+            The quantiles to estimate, between 0 and 1.
+        alpha : float
+            The weight of every new state in the EWMA.
+        """
+        self.quantiles = np.asarray(quantiles, dtype="float64")
+        self.alpha = float(alpha)
+        nq = len(self.quantiles)
+        self.count = np.zeros(0, dtype="int64")
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+        self.ewma = np.full(0, np.nan)
+        self.heights = np.full((0, nq, 5), np.nan)
+        self.positions = np.zeros((0, nq, 5))
+        self.desired = np.zeros((0, nq, 5))
+
+    def __len__(self) -> int:
+        """The number of entities with numeric states."""
+        return int(np.count_nonzero(self.count))
+
+    def _grow(self, size) -> None:
+        """Make room for metadata_ids below `size`."""
+        grow = size - len(self.count)
+        if grow <= 0:
+            return
+        nq = len(self.quantiles)
+        self.count = np.r_[self.count, np.zeros(grow, dtype="int64")]
+        self.mean = np.r_[self.mean, np.zeros(grow)]
+        self.m2 = np.r_[self.m2, np.zeros(grow)]
+        self.ewma = np.r_[self.ewma, np.full(grow, np.nan)]
+        self.heights = np.concatenate([self.heights, np.full((grow, nq, 5), np.nan)])
+        self.positions = np.concatenate([self.positions, np.zeros((grow, nq, 5))])
+        self.desired = np.concatenate([self.desired, np.zeros((grow, nq, 5))])
+
+    @property
+    def variance(self) -> np.ndarray:
+        """The sample variance per metadata_id, NaN below two states."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+    @property
+    def std(self) -> np.ndarray:
+        """The sample standard deviation per metadata_id."""
+        return np.sqrt(self.variance)
+
+    def update(self, ids, values) -> None:
+        """
+        Add states to the statistics.
+
+        Arguments:
+        - ids: The metadata_id of every state.
+        - values: The numeric states, in chronological order per entity.
+            NaN values are skipped.
+        """
+        ids = np.asarray(ids, dtype="int64")
+        values = np.asarray(values, dtype="float64")
+        keep = ~np.isnan(values)
+        ids, values = ids[keep], values[keep]
+        if not len(ids):
+            return
+        self._grow(int(ids.max()) + 1)
+        size = len(self.count)
+        ranks = _group_ranks(ids)
+
+        # Welford's mean and variance of the batch, merged with the totals.
+        counts = np.bincount(ids, minlength=size)
+        seen = counts > 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.bincount(ids, values, minlength=size) / counts
+            m2 = np.bincount(ids, (values - means[ids]) ** 2, minlength=size)
+            total = self.count + counts
+            delta = means - self.mean
+            self.m2[seen] = (self.m2 + m2 + delta**2 * self.count * counts / total)[
+                seen
+            ]
+            self.mean[seen] = (self.mean + delta * counts / total)[seen]
+
+        # The EWMA after k states is (1 - alpha)^k times the previous one
+        # plus the states weighted by alpha (1 - alpha)^(states after it).
+        # Entities without states start from their first one.
+        decay = 1 - self.alpha
+        first = ranks == 0
+        start = self.ewma.copy()
+        new = np.isnan(start)
+        start[ids[first & new[ids]]] = values[first & new[ids]]
+        after = counts[ids] - 1 - ranks
+        weighted = np.bincount(ids, self.alpha * decay**after * values, minlength=size)
+        self.ewma[seen] = (decay**counts * start + weighted)[seen]
+
+        # P² updates each entity one state at a time, so process the first
+        # state of every entity in the batch, then the second and so on.
+        order = np.lexsort((ids, ranks))
+        bounds = np.searchsorted(ranks[order], np.arange(ranks.max() + 2))
+        for start_row, end_row in zip(bounds[:-1], bounds[1:]):
+            rows = order[start_row:end_row]
+            self._p2_update(ids[rows], values[rows], self.count[ids[rows]])
+            self.count[ids[rows]] += 1
+
+    def _p2_update(self, ids, values, counts) -> None:
+        """Add one state to the P² markers of each of `ids`, all distinct."""
+        filling = counts < 5
+        if filling.any():
+            fill_ids = ids[filling]
+            self.heights[fill_ids, :, counts[filling]] = values[filling, None]
+            full = fill_ids[counts[filling] == 4]
+            if len(full):
+                p = self.quantiles
+                self.heights[full] = np.sort(self.heights[full], axis=-1)
+                self.positions[full] = np.arange(1, 6)
+                self.desired[full] = np.stack(
+                    [
+                        np.ones_like(p),
+                        1 + 2 * p,
+                        1 + 4 * p,
+                        3 + 2 * p,
+                        np.full_like(p, 5),
+                    ],
+                    axis=-1,
+                )
+        ids, values = ids[~filling], values[~filling, None]
+        if not len(ids):
+            return
+
+        q, n = self.heights[ids], self.positions[ids]
+        q[..., 0] = np.minimum(q[..., 0], values)
+        q[..., 4] = np.maximum(q[..., 4], values)
+        cell = (values[..., None] >= q[..., 1:4]).sum(axis=-1)
+        n += np.arange(5) > cell[..., None]
+        p = self.quantiles
+        increments = np.stack(
+            [np.zeros_like(p), p / 2, p, (1 + p) / 2, np.ones_like(p)], axis=-1
+        )
+        desired = self.desired[ids] + increments
+
+        for i in (1, 2, 3):
+            d = desired[..., i] - n[..., i]
+            right = n[..., i + 1] - n[..., i]
+            left = n[..., i - 1] - n[..., i]
+            move = ((d >= 1) & (right > 1)) | ((d <= -1) & (left < -1))
+            s = np.sign(d)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                parabolic = q[..., i] + s / (n[..., i + 1] - n[..., i - 1]) * (
+                    (-left + s) * (q[..., i + 1] - q[..., i]) / right
+                    + (right - s) * (q[..., i] - q[..., i - 1]) / -left
+                )
+                neighbour = np.where(s > 0, i + 1, i - 1)
+                q_next = np.take_along_axis(q, neighbour[..., None], -1)[..., 0]
+                n_next = np.take_along_axis(n, neighbour[..., None], -1)[..., 0]
+                linear = q[..., i] + s * (q_next - q[..., i]) / (n_next - n[..., i])
+            inside = (q[..., i - 1] < parabolic) & (parabolic < q[..., i + 1])
+            q[..., i] = np.where(move, np.where(inside, parabolic, linear), q[..., i])
+            n[..., i] += np.where(move, s, 0)
+
+        self.heights[ids], self.positions[ids] = q, n
+        self.desired[ids] = desired
+
+    def quantile_estimates(self) -> np.ndarray:
+        """
+        The estimated quantiles per metadata_id, an array of shape (ids,
+        quantiles). Entities with less than five states get the exact
+        quantiles of their states, NaN without states.
+        """
+        estimates = self.heights[..., 2].copy()
+        few = (self.count > 0) & (self.count < 5)
+        if few.any():
+            # The markers hold the states themselves until the fifth.
+            estimates[few] = np.nanquantile(
+                self.heights[few, 0], self.quantiles, axis=-1
+            ).T
+        estimates[self.count == 0] = np.nan
+        return estimates
+
+    def zscores(self, ids, values) -> np.ndarray:
+        """
+        Score states by their distance to the mean of their entity, in
+        standard deviations. NaN for entities with less than two states.
+        """
+        ids = np.asarray(ids, dtype="int64")
+        values = np.asarray(values, dtype="float64")
+        known = ids < len(self.count)
+        mean = np.full(len(ids), np.nan)
+        std = np.full(len(ids), np.nan)
+        mean[known] = self.mean[ids[known]]
+        std[known] = self.std[ids[known]]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (values - mean) / std
+
+    def update_frame(self, df: pd.DataFrame, metadata_ids) -> pd.Series:
+        """
+        Score the states of a frame like those of fetch_all_data_of or
+        HassDatabase.tail against the statistics so far, then add them.
+
+        Arguments:
+        - df: States with entity_id, state and last_updated_ts columns.
+            Non-numeric states are skipped and score NaN.
+        - metadata_ids: The metadata_id of every entity_id, e.g.
+            HassDatabase.metadata_ids. Unknown entities are skipped.
+
+        Returns the z-scores of the states, with the index of `df`.
+        """
+        ids = df["entity_id"].map(metadata_ids).to_numpy("float64")
+        values = pd.to_numeric(df["state"], errors="coerce").to_numpy("float64")
+        keep = ~np.isnan(ids)
+        values = np.where(keep, values, np.nan)
+        ids = np.where(keep, ids, 0).astype("int64")
+
+        scores = pd.Series(self.zscores(ids, values), index=df.index)
+        order = np.argsort(df["last_updated_ts"].to_numpy(), kind="stable")
+        self.update(ids[order], values[order])
+        return scores
+
+    def to_frame(self, metadata_ids=None) -> pd.DataFrame:
+        """
+        Summarize the statistics of every entity with numeric states in a
+        frame indexed by metadata_id, or by entity_id if the
+        `metadata_ids` mapping of entity_id to metadata_id is given.
+        """
+        ids = np.flatnonzero(self.count)
+        df = pd.DataFrame(
+            {
+                "count": self.count[ids],
+                "mean": self.mean[ids],
+                "std": self.std[ids],
+                "ewma": self.ewma[ids],
+            },
+            index=pd.Index(ids, name="metadata_id"),
+        )
+        estimates = self.quantile_estimates()[ids]
+        for j, p in enumerate(self.quantiles):
+            df[f"q{p:g}"] = estimates[:, j]
+        if metadata_ids is not None:
+            entity_ids = {metadata_id: e for e, metadata_id in metadata_ids.items()}
+            df.index = pd.Index(df.index.map(entity_ids), name="entity_id")
+        return df
+
+    def save(self, path) -> None:
+        """Save the statistics to a NumPy .npz file."""
+        arrays = {name: getattr(self, name) for name in self._ARRAYS}
+        np.savez_compressed(path, quantiles=self.quantiles, alpha=self.alpha, **arrays)
+
+    @classmethod
+    def load(cls, path) -> "OnlineStats":
+        """Load statistics saved with `save`."""
+        with np.load(path) as data:
+            stats = cls(data["quantiles"], float(data["alpha"]))
+            for name in cls._ARRAYS:
+                setattr(stats, name, data[name])
+        return stats
@@ -0,0 +1,181 @@
+"""
+Run-length intervals of entity states.
+"""
+
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+
+def _epoch_ms(last_updated) -> np.ndarray:
+    """Convert epoch seconds or naive UTC datetimes to int64 epoch ms."""
+    if pd.api.types.is_datetime64_any_dtype(last_updated):
+        if getattr(last_updated.dt, "tz", None) is not None:
+            last_updated = last_updated.dt.tz_convert(None)
+        return last_updated.astype("datetime64[ms]").to_numpy().view("int64")
+    return np.round(last_updated.to_numpy(dtype="float64") * 1000).astype("int64")
+
+
+def _changes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return the rows of a state frame at which the state of an entity
+    changes, sorted by entity and time, with last_updated_ts in epoch ms.
+    """
+    df = pd.DataFrame(
+        {
+            "entity_id": df["entity_id"].to_numpy(),
+            "state": df["state"].astype(str).to_numpy(),
+            "last_updated_ts": _epoch_ms(df["last_updated_ts"]),
+        }
+    )
+    return _drop_repeats(df)
+
+
+def _drop_repeats(df: pd.DataFrame) -> pd.DataFrame:
+    """Drop the rows repeating the previous state of their entity."""
+    df = df.sort_values(["entity_id", "last_updated_ts"], kind="stable")
+    entity = df["entity_id"].to_numpy()
+    state = df["state"].to_numpy()
+    changed = np.ones(len(df), dtype=bool)
+    changed[1:] = (entity[1:] != entity[:-1]) | (state[1:] != state[:-1])
+    return df[changed]
+
+
+class StateIntervals:
+    """
+    The states of entities as run-length intervals: when a state started,
+    when it ended and its value, with consecutive duplicate states merged.
+
+    The intervals of all entities are stored in flat int64 and categorical
+    arrays, entity i owning the slice offsets[i]:offsets[i + 1], so memory
+    grows with the number of state changes instead of recorded rows. Times
+    are int64 epoch milliseconds (UTC).
+    """
+
+    def __init__(self, entities, offsets, starts, ends, states):
+        self.entities = list(entities)
+        self.offsets = offsets
+        self.starts = starts
+        self.ends = ends
+        self.states = states
+        self._index = {entity: i for i, entity in enumerate(self.entities)}
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, end=None) -> "StateIntervals":
+        """
+        Build intervals from a frame with entity_id, state and
+        last_updated_ts, like the ones fetch_all_data_of returns.
+
+        The last state of every entity lasts until `end`, by default the
+        latest last_updated_ts in the frame.
+        """
+        return cls._from_changes(_changes(df), end)
+
+    @classmethod
+    def from_frames(cls, frames: Iterable[pd.DataFrame], end=None) -> "StateIntervals":
+        """
+        Build intervals from a stream of frames, e.g. iter_all_data_of,
+        keeping only the state changes of each frame in memory.
+        """
+        changes = [_changes(df) for df in frames]
+        if not changes:
+            return cls.from_frame(
+                pd.DataFrame({"entity_id": [], "state": [], "last_updated_ts": []}),
+                end,
+            )
+        return cls._from_changes(_drop_repeats(pd.concat(changes)), end)
+
+    @classmethod
+    def _from_changes(cls, changes: pd.DataFrame, end) -> "StateIntervals":
+        codes, entities = pd.factorize(changes["entity_id"], sort=True)
+        starts = changes["last_updated_ts"].to_numpy()
+        counts = np.bincount(codes, minlength=len(entities))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype("int64")
+
+        if end is None:
+            end_ms = starts.max() if len(starts) else 0
+        else:
+            end_ms = _epoch_ms(pd.Series(pd.to_datetime([end], utc=True)))[0]
+        # A state lasts until the next state of the same entity.
+        ends = np.empty_like(starts)
+        ends[:-1] = starts[1:]
+        ends[offsets[1:] - 1] = end_ms
+
+        states = pd.Categorical(changes["state"].to_numpy())
+        return cls(entities, offsets, starts, ends, states)
+
+    def _slice(self, entity) -> slice:
+        i = self._index[entity]
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Return the intervals as a frame with naive UTC datetimes."""
+        entity_codes = np.repeat(np.arange(len(self.entities)), np.diff(self.offsets))
+        return pd.DataFrame(
+            {
+                "entity_id": pd.Categorical.from_codes(entity_codes, self.entities),
+                "state": self.states,
+                "start": self.starts.astype("datetime64[ms]"),
+                "end": self.ends.astype("datetime64[ms]"),
+                "duration": (self.ends - self.starts).astype("timedelta64[ms]"),
+            }
+        )
+
+    def state_at(self, entity, when):
+        """
+        Return the state of an entity at one or more naive UTC datetimes,
+        found by binary search. Times before the first state are None.
+        """
+        scalar = np.ndim(when) == 0
+        times = _epoch_ms(pd.Series(pd.to_datetime(np.atleast_1d(when))))
+        span = self._slice(entity)
+        positions = np.searchsorted(self.starts[span], times, side="right") - 1
+        codes = np.where(
+            positions >= 0, self.states.codes[span][np.maximum(positions, 0)], -1
+        )
+        states = np.asarray(
+            pd.Categorical.from_codes(codes, self.states.categories), dtype=object
+        )
+        states[pd.isna(states)] = None
+        return states[0] if scalar else states
+
+    def total_time(self, state, freq="D", tz=None) -> pd.DataFrame:
+        """
+        Return how long each entity was in `state` per period of `freq`,
+        e.g. the on-time per day, as a frame of timedeltas with a column per
+        entity. Periods start at midnight of the first day in time zone `tz`,
+        UTC by default, and are labelled with their naive local start.
+        """
+        if len(self) == 0:
+            return pd.DataFrame(columns=self.entities, dtype="timedelta64[ms]")
+        first = pd.Timestamp(self.starts.min(), unit="ms", tz="UTC")
+        last = pd.Timestamp(self.ends.max(), unit="ms", tz="UTC")
+        if tz is not None:
+            first, last = first.tz_convert(tz), last.tz_convert(tz)
+        bounds = pd.date_range(first.normalize(), last, freq=freq)
+        bounds = bounds.append(pd.DatetimeIndex([bounds[-1] + bounds.freq]))
+        bounds_ms = bounds.tz_convert(None).as_unit("ms").asi8
+
+        code = self.states.categories.get_indexer([state])[0]
+        totals = {}
+        for entity in self.entities:
+            span = self._slice(entity)
+            match = self.states.codes[span] == code
+            starts, ends = self.starts[span][match], self.ends[span][match]
+            if not len(starts):
+                totals[entity] = np.zeros(len(bounds) - 1, dtype="timedelta64[ms]")
+                continue
+            # Time spent in the state up to each bound: all intervals before
+            # the one the bound falls in plus the elapsed part of that one.
+            before = np.concatenate([[0], np.cumsum(ends - starts)])
+            positions = np.searchsorted(starts, bounds_ms, side="right")
+            i = np.maximum(positions - 1, 0)
+            elapsed = np.clip(bounds_ms - starts[i], 0, ends[i] - starts[i])
+            cumulative = np.where(positions > 0, before[i] + elapsed, 0)
+            totals[entity] = np.diff(cumulative).astype("timedelta64[ms]")
+
+        return pd.DataFrame(totals, index=bounds[:-1].tz_localize(None))
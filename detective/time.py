@@ -1,29 +1,63 @@
 """
 Helper functions for datetimes.
+
+pytz, numpy and pandas are imported on first use.
 """
 
 import time
 from datetime import datetime
 
-import pytz
-
-UTC = pytz.UTC
 # Ordered list of time categories that `time_category` produces
 TIME_CATEGORIES = ["morning", "daytime", "evening", "night"]
+# Format of the datetime strings SQLAlchemy returns
+SQLALCHEMY_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def __getattr__(name):
+    # UTC is pytz.UTC. LOCAL_UTC_OFFSET is the UTC offset of the local time
+    # zone when first accessed, localize uses the offset at the time of the
+    # datetime instead so it is correct across DST changes.
+    if name == "UTC":
+        return _utc()
+    if name == "LOCAL_UTC_OFFSET":
+        now_ts = time.time()
+        offset = datetime.fromtimestamp(now_ts) - datetime.fromtimestamp(
+            now_ts, _utc()
+        ).replace(tzinfo=None)
+        globals()[name] = offset
+        return offset
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _utc():
+    import pytz
+
+    return pytz.UTC
+
+
+def _local_utc_offset(timestamp):
+    """Return the UTC offset of the local time zone at an epoch timestamp."""
+    return datetime.fromtimestamp(timestamp, _utc()).astimezone().utcoffset()
+
 
-# To localize the returned UTC times to local times
-_now_ts = time.time()
-LOCAL_UTC_OFFSET = datetime.fromtimestamp(_now_ts) - datetime.fromtimestamp(
-    _now_ts, UTC
-).replace(tzinfo=None)
+def _timezone(tz):
+    import pytz
 
+    return pytz.timezone(tz) if isinstance(tz, str) else tz
 
-def localize(dt):
-    """Localize a datetime object to local time."""
-    if dt.tzinfo is UTC:
-        return (dt + LOCAL_UTC_OFFSET).replace(tzinfo=None)
-    # No TZ info so not going to assume anything, return as-is.
-    return dt
+
+def localize(dt, tz=None):
+    """
+    Localize a datetime object to local time, or to the time zone `tz`,
+    e.g. the one from `config.time_zone_from_hass_config`.
+    """
+    if dt.tzinfo is None:
+        # No TZ info so not going to assume anything, return as-is.
+        return dt
+    if tz is None:
+        utc = dt.astimezone(_utc())
+        return (utc + _local_utc_offset(utc.timestamp())).replace(tzinfo=None)
+    return dt.astimezone(_timezone(tz)).replace(tzinfo=None)
 
 
 def is_weekday(dtObj):
@@ -45,8 +79,134 @@ def time_category(dtObj):
 
 def sqlalch_datetime(dt):
     """Convert a SQLAlchemy datetime string to a datetime object."""
+    utc = _utc()
     if isinstance(dt, str):
-        return datetime.strptime(dt, "%Y-%m-%d %H:%M:%S.%f").replace(tzinfo=UTC)
+        return datetime.strptime(dt, SQLALCHEMY_FORMAT).replace(tzinfo=utc)
     if dt.tzinfo is not None and dt.tzinfo.utcoffset(dt) is not None:
-        return dt.astimezone(UTC)
-    return dt.replace(tzinfo=UTC)
+        return dt.astimezone(utc)
+    return dt.replace(tzinfo=utc)
+
+
+def to_timestamp(dt):
+    """
+    Convert a datetime, ISO 8601 string or number to a UTC epoch timestamp.
+
+    Naive datetimes are assumed to be in UTC, like the recorder stores them.
+    """
+    if isinstance(dt, (int, float)):
+        return float(dt)
+    if isinstance(dt, str):
+        dt = datetime.fromisoformat(dt)
+    return sqlalch_datetime(dt).timestamp()
+
+
+# Vectorized versions of the helpers above, for arrays and Series of
+# datetimes. Series results keep the index of their input.
+
+
+def _like(values, result):
+    import pandas as pd
+
+    if isinstance(values, pd.Series):
+        return pd.Series(result, index=values.index, name=values.name)
+    return result
+
+
+def _datetimes(values):
+    import pandas as pd
+
+    return pd.DatetimeIndex(values)
+
+
+def _local_transitions(start, end):
+    """
+    Return a transition table of the local time zone between two epoch
+    timestamps: the sorted epoch seconds at which the UTC offset changes,
+    starting with `start`, and the offset from then on.
+
+    The offset is sampled once a day and a day on which it changes is
+    searched by half hour, at which DST transitions happen.
+    """
+    import numpy as np
+    import pandas as pd
+
+    days = list(range(int(start // 86400 * 86400), int(end) + 86400, 86400))
+    times = [days[0]]
+    offsets = [_local_utc_offset(days[0])]
+    for day in days[1:]:
+        if _local_utc_offset(day) == offsets[-1]:
+            continue
+        for slot in range(day - 86400, day + 1, 1800):
+            offset = _local_utc_offset(slot)
+            if offset != offsets[-1]:
+                times.append(slot)
+                offsets.append(offset)
+                break
+    return np.array(times), pd.TimedeltaIndex(offsets)
+
+
+def _local_offsets(utc):
+    """Return the UTC offsets of the local time zone at naive UTC datetimes."""
+    import numpy as np
+    import pandas as pd
+
+    seconds = ((utc - pd.Timestamp(0)) / pd.Timedelta(seconds=1)).to_numpy()
+    valid = seconds[~np.isnan(seconds)]
+    if len(valid) == 0:
+        return pd.TimedeltaIndex(np.zeros(len(seconds), dtype="timedelta64[s]"))
+    times, offsets = _local_transitions(valid.min(), valid.max())
+    # NaT stays NaT whatever offset it gets.
+    seconds = np.nan_to_num(seconds, nan=valid.min())
+    return offsets[np.searchsorted(times, seconds, side="right") - 1]
+
+
+def localize_series(values, tz=None):
+    """
+    Localize datetimes to local time or the time zone `tz`, like `localize`,
+    with one vectorized conversion.
+    """
+    datetimes = _datetimes(values)
+    if datetimes.tz is None:
+        # No TZ info so not going to assume anything, return as-is.
+        return _like(values, datetimes)
+    if tz is not None:
+        return _like(values, datetimes.tz_convert(_timezone(tz)).tz_localize(None))
+    utc = datetimes.tz_convert("UTC").tz_localize(None)
+    return _like(values, utc + _local_offsets(utc))
+
+
+def weekday_mask(values):
+    """Return a boolean mask of the datetimes that are on a weekday."""
+    return _like(values, _datetimes(values).weekday.to_numpy() < 5)
+
+
+def time_categories(values):
+    """
+    Return the `time_category` of datetimes as a categorical ordered like
+    TIME_CATEGORIES.
+    """
+    import numpy as np
+    import pandas as pd
+
+    hours = _datetimes(values).hour.to_numpy()
+    codes = np.select(
+        [
+            (5 <= hours) & (hours < 9),
+            (9 <= hours) & (hours <= 17),
+            (17 < hours) & (hours < 23),
+        ],
+        # Codes of morning, daytime and evening, the rest is night.
+        [0, 1, 2],
+        default=3,
+    )
+    categories = pd.Categorical.from_codes(codes, TIME_CATEGORIES, ordered=True)
+    return _like(values, categories)
+
+
+def sqlalch_datetimes(values):
+    """Convert SQLAlchemy datetime strings or datetimes to UTC datetimes."""
+    import pandas as pd
+
+    if pd.api.types.infer_dtype(values, skipna=True) == "string":
+        return pd.to_datetime(values, format=SQLALCHEMY_FORMAT, utc=True)
+    return pd.to_datetime(values, utc=True)
@@ -7,6 +7,13 @@ REQUIRES = [
     "pytz",
 ]
 
+EXTRAS_REQUIRE = {
+    "arrow": ["pyarrow>=14.0.0"],
+    "polars": ["pyarrow>=14.0.0", "polars"],
+    "adbc": ["pyarrow>=14.0.0", "adbc-driver-sqlite"],
+    "async": ["SQLAlchemy[asyncio]>=2.0.7", "aiosqlite"],
+}
+
 PROJECT_DESCRIPTION = "Tools for studying Home Assistant data."
 PROJECT_LONG_DESCRIPTION = (
     "Home Assistant is an open-source "
@@ -27,6 +34,8 @@ setup(
     description=PROJECT_DESCRIPTION,
     long_description=PROJECT_LONG_DESCRIPTION,
     install_requires=REQUIRES,
+    extras_require=EXTRAS_REQUIRE,
+    entry_points={"console_scripts": ["detective = detective.cli:main"]},
     python_requires=">=3.12,<3.13",
     license="MIT",
     classifiers=[
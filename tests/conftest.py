@@ -1,3 +1,4 @@
+import shutil
 from unittest.mock import patch
 
 import pytest
@@ -9,3 +10,11 @@ from detective.core import HassDatabase
 def mock_db():
     with patch('detective.core.create_engine'):
         return HassDatabase('mock://db')
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """A copy of the test database, that tests can write to."""
+    path = tmp_path / "test.db"
+    shutil.copy("tests/test.db", path)
+    return path
@@ -0,0 +1,44 @@
+"""Tests for the asyncio database."""
+
+import asyncio
+
+import pandas as pd
+import pytest
+
+from detective.core import HassDatabase
+
+pytest.importorskip("aiosqlite")
+pytest.importorskip("greenlet")
+
+from detective.aio import AsyncHassDatabase, async_url  # noqa: E402
+
+db_url = "sqlite:///tests/test.db"
+
+
+def test_async_url():
+    assert str(async_url("sqlite:///home.db")) == "sqlite+aiosqlite:///home.db"
+    assert str(async_url("postgresql://u@host/db")) == "postgresql+asyncpg://u@host/db"
+    assert str(async_url("mysql+pymysql://u@host/db")) == "mysql+aiomysql://u@host/db"
+    assert str(async_url("postgresql+asyncpg://h/db")) == "postgresql+asyncpg://h/db"
+
+
+def test_async_fetches_match_sync_fetches():
+    sensors = ("sun.sun", "zone.home", "sensor.*")
+    expected = HassDatabase(db_url).fetch_all_data_of(sensors)
+
+    async def fetch():
+        async with AsyncHassDatabase(db_url) as db:
+            assert len(db.entities) > 0
+            df, statistics = await asyncio.gather(
+                db.fetch_all_data_of(sensors),
+                db.fetch_all_statistics_of(("sensor.kitchen",)),
+            )
+            chunks = [chunk async for chunk in db.iter_all_data_of(sensors, 2)]
+        return df, statistics, chunks
+
+    df, statistics, chunks = asyncio.run(fetch())
+
+    pd.testing.assert_frame_equal(df, expected)
+    assert statistics.empty
+    assert max(len(chunk) for chunk in chunks) == 2
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected)
@@ -0,0 +1,63 @@
+"""Tests for the Parquet cache."""
+import sqlite3
+from unittest.mock import patch
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from detective.cache import ParquetCache  # noqa: E402
+from detective.core import HassDatabase  # noqa: E402
+
+
+def test_cache_serves_history_and_refreshes_incrementally(db_path, tmp_path):
+    db = HassDatabase(f"sqlite:///{db_path}", fetch_entities=False)
+    cache = ParquetCache(db, tmp_path / "cache")
+    sensors = ("sun.sun", "sensor.*")
+
+    cached = cache.fetch_all_data_of(sensors)
+    assert cached.equals(db.fetch_all_data_of(sensors))
+
+    with sqlite3.connect(db_path) as con:
+        con.execute(
+            "INSERT INTO states (state_id, state, last_updated_ts, metadata_id) "
+            "VALUES (10, 'above_horizon', 1680330000.0, 1)"
+        )
+
+    # A new cache instance picks up the high-water marks from the manifest.
+    cache = ParquetCache(db, tmp_path / "cache")
+    assert cache.refresh(sensors) == 1
+    assert cache.refresh(sensors) == 0
+
+    cached = cache.fetch_all_data_of(sensors, refresh=False)
+    assert cached.equals(db.fetch_all_data_of(sensors))
+
+    recent = cache.fetch_all_data_of(("sun.sun",), start=1680323986, refresh=False)
+    assert list(recent.state_id) == [10]
+
+
+def test_cache_keeps_every_chunk_and_retries_idempotently(db_path, tmp_path):
+    with sqlite3.connect(db_path) as con:
+        con.executemany(
+            "INSERT INTO states (state_id, state, last_updated_ts, metadata_id) "
+            "VALUES (?, ?, ?, 1)",
+            [(100 + i, str(i), 1680330000.0 + i * 3600) for i in range(50)],
+        )
+    db = HassDatabase(f"sqlite:///{db_path}", fetch_entities=False)
+    cache = ParquetCache(db, tmp_path / "cache")
+
+    # A refresh that fails before saving its high-water marks.
+    with patch.object(ParquetCache, "_save_manifest", side_effect=OSError):
+        with pytest.raises(OSError):
+            cache.refresh(("sun.sun",), chunksize=7)
+    with sqlite3.connect(db_path) as con:
+        con.execute(
+            "INSERT INTO states (state_id, state, last_updated_ts, metadata_id) "
+            "VALUES (200, 'new', 1680600000.0, 1)"
+        )
+
+    cache = ParquetCache(db, tmp_path / "cache")
+    assert cache.refresh(("sun.sun",), chunksize=7) == 52
+    cached = cache.fetch_all_data_of(("sun.sun",), refresh=False)
+    assert len(cached) == 52
+    assert cached.equals(db.fetch_all_data_of(("sun.sun",)))
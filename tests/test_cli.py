@@ -0,0 +1,103 @@
+"""Tests for the command line tool."""
+import sqlite3
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+
+from detective import cli
+
+DB_URL = "sqlite:///tests/test.db"
+
+
+def test_export_csv_partitioned_by_entity_and_day(tmp_path):
+    argv = ["-q", "--db-url", DB_URL, "export", "--entities", "sensor.sun_next_*"]
+    argv += ["--since", "2023-04-01", "--format", "csv", "--out", str(tmp_path)]
+    assert cli.main(argv + ["--chunksize", "4"]) == 0
+
+    files = sorted(tmp_path.glob("entity_id=*/date=*/*.csv"))
+    assert len(files) == 6
+    assert files[0].relative_to(tmp_path).as_posix() == (
+        "entity_id=sensor.sun_next_dawn/date=2023-04-01/part.csv"
+    )
+    df = pd.read_csv(files[0])
+    assert list(df.columns) == ["state", "last_updated_ts", "state_id"]
+    assert df["state"].tolist() == ["2023-04-01T05:39:42+00:00"]
+
+    # Exporting again replaces the files.
+    assert cli.main(argv) == 0
+    assert sorted(tmp_path.glob("entity_id=*/date=*/*.csv")) == files
+
+
+def test_export_again_rewrites_whole_days(db_path, tmp_path):
+    rows = [(100 + i, str(i), 1680330000.0 + i * 3600) for i in range(60)]
+    with sqlite3.connect(db_path) as con:
+        con.executemany(
+            "INSERT INTO states (state_id, state, last_updated_ts, metadata_id) "
+            "VALUES (?, ?, ?, 1)",
+            rows,
+        )
+    out = tmp_path / "export"
+    argv = ["-q", "--db-url", f"sqlite:///{db_path}", "export", "--entities", "sun.sun"]
+    argv += ["--format", "csv", "--out", str(out), "--chunksize", "7"]
+    assert cli.main(argv + ["--since", "2023-04-02T12:00"]) == 0
+    # The partial first day is exported in full.
+    first = pd.read_csv(out / "entity_id=sun.sun" / "date=2023-04-02" / "part.csv")
+    assert len(first) == 24
+
+    with sqlite3.connect(db_path) as con:
+        con.execute(
+            "INSERT INTO states (state_id, state, last_updated_ts, metadata_id) "
+            "VALUES (200, 'new', 1680540000.0, 1)"
+        )
+    assert cli.main(argv) == 0
+
+    files = sorted(out.glob("entity_id=sun.sun/date=*/*.csv"))
+    assert [file.parent.name for file in files] == [
+        "date=2023-04-01",
+        "date=2023-04-02",
+        "date=2023-04-03",
+    ]
+    exported = pd.concat([pd.read_csv(file) for file in files])
+    assert len(exported) == 62
+    assert exported["state_id"].is_unique
+    assert exported["last_updated_ts"].is_monotonic_increasing
+
+
+def test_export_parquet_reads_back_as_dataset(tmp_path):
+    ds = pytest.importorskip("pyarrow.dataset")
+    argv = ["-q", "--db-url", DB_URL, "export", "--entities", "sun.sun", "sensor.*"]
+    assert cli.main(argv + ["--until", "2024-01-01", "--out", str(tmp_path)]) == 0
+
+    table = ds.dataset(tmp_path, partitioning="hive").to_table()
+    assert table.num_rows == 7
+    assert set(table["entity_id"].to_pylist()) >= {"sun.sun", "sensor.sun_next_noon"}
+
+
+def test_export_only_logs_queries_when_verbose(tmp_path, caplog):
+    argv = ["--db-url", DB_URL, "export", "--entities", "sensor.*"]
+    argv += ["--out", str(tmp_path)]
+    with caplog.at_level("INFO"):
+        assert cli.main(argv) == 0
+    assert any(record.name == "detective.cli" for record in caplog.records)
+    assert not any("Query" in record.message for record in caplog.records)
+
+    caplog.clear()
+    with caplog.at_level("DEBUG"):
+        assert cli.main(["-v"] + argv) == 0
+    assert any("Query returned" in record.message for record in caplog.records)
+
+
+def test_export_discovers_db_and_reports_failures(tmp_path):
+    argv = ["-q", "export", "--entities", "sun.sun", "--out", str(tmp_path)]
+    with patch("detective.config.find_hass_config", return_value="mock-path"), patch(
+        "detective.config.db_url_from_hass_config", return_value=DB_URL
+    ) as db_url:
+        assert cli.main(argv) == 0
+    db_url.assert_called_once_with("mock-path")
+    assert len(list(tmp_path.glob("entity_id=sun.sun/*/*.parquet"))) == 1
+
+    with patch(
+        "detective.config.find_hass_config", side_effect=ValueError("no config")
+    ):
+        assert cli.main(argv) == 1
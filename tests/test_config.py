@@ -5,6 +5,7 @@ from pathlib import Path
 from unittest.mock import patch
 
 import pytest
+from ruamel.yaml import YAML
 
 from detective import config
 
@@ -91,3 +92,94 @@ def test_db_url_from_hass_config():
         return_value={"recorder": {"db_url": "mock-url"}},
     ):
         assert config.db_url_from_hass_config("mock-path") == "mock-url"
+
+
+def test_time_zone_from_hass_config():
+    """Test extracting the time zone from config."""
+    with patch(
+        "detective.config.load_hass_config",
+        return_value={"homeassistant": {"time_zone": "Europe/Amsterdam"}},
+    ):
+        assert config.time_zone_from_hass_config("mock-path") == "Europe/Amsterdam"
+
+    with patch("detective.config.load_hass_config", return_value={}):
+        assert config.time_zone_from_hass_config("mock-path") is None
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def test_load_hass_config_include_dirs(tmp_path):
+    """Test the !include_dir_* tags."""
+    write(
+        tmp_path / "configuration.yaml",
+        """
+dir_list: !include_dir_list lists
+dir_merge_list: !include_dir_merge_list lists
+dir_named: !include_dir_named named
+dir_merge_named: !include_dir_merge_named named
+missing_list: !include_dir_list missing
+missing_named: !include_dir_named missing
+""",
+    )
+    write(tmp_path / "secrets.yaml", "password: hunter2")
+    write(tmp_path / "lists" / "b.yaml", "- 3")
+    write(tmp_path / "lists" / "a.yaml", "- 1\n- 2")
+    write(tmp_path / "lists" / ".hidden.yaml", "- 4")
+    write(tmp_path / "named" / "kitchen.yaml", "name: kitchen")
+    write(tmp_path / "named" / "sub" / "garden.yaml", "password: !secret password")
+
+    configuration = config.load_hass_config(tmp_path)
+
+    assert configuration["dir_list"] == [[1, 2], [3]]
+    assert configuration["dir_merge_list"] == [1, 2, 3]
+    assert configuration["dir_named"] == {
+        "kitchen": {"name": "kitchen"},
+        "garden": {"password": "hunter2"},
+    }
+    assert configuration["dir_merge_named"] == {
+        "name": "kitchen",
+        "password": "hunter2",
+    }
+    assert configuration["missing_list"] == []
+    assert configuration["missing_named"] == {}
+
+
+def test_load_hass_config_only_parses_changed_files(tmp_path):
+    """Test that parsed files are cached until they change."""
+    write(tmp_path / "configuration.yaml", "included: !include included.yaml")
+    write(tmp_path / "included.yaml", "some: value")
+    write(tmp_path / "other.yaml", "other: !include_dir_list lists")
+    load = YAML.load
+
+    with patch.object(YAML, "load", autospec=True, side_effect=load) as parse:
+        assert config.load_hass_config(tmp_path) == {"included": {"some": "value"}}
+        assert parse.call_count == 2
+
+        configuration = config.load_hass_config(tmp_path)
+        configuration["included"]["some"] = "changed in place"
+        assert config.load_hass_config(tmp_path) == {"included": {"some": "value"}}
+        assert parse.call_count == 2
+
+        write(tmp_path / "included.yaml", "some: other value")
+        assert config.load_hass_config(tmp_path) == {
+            "included": {"some": "other value"}
+        }
+        assert parse.call_count == 4
+
+        assert config.load_yaml(tmp_path / "other.yaml") == {"other": []}
+        write(tmp_path / "lists" / "a.yaml", "- 1")
+        assert config.load_yaml(tmp_path / "other.yaml") == {"other": [[1]]}
+
+
+def test_db_url_from_hass_config_packages(tmp_path):
+    """Test finding the recorder in a package."""
+    write(
+        tmp_path / "configuration.yaml",
+        "homeassistant:\n  packages: !include_dir_named packages\n",
+    )
+    write(tmp_path / "packages" / "database.yaml", "recorder:\n  db_url: mock-url")
+
+    assert config.db_url_from_hass_config(tmp_path) == "mock-url"
@@ -1,5 +1,8 @@
-from unittest.mock import patch, MagicMock
+import subprocess
+import sys
+from unittest.mock import patch
 import pandas as pd
+from sqlalchemy import text
 
 from detective.core import get_db_type, stripped_db_url, HassDatabase
 
@@ -18,6 +21,19 @@ def test_stripped_db_url():
     )
 
 
+def test_import_is_lazy():
+    """Test that importing detective doesn't load pandas or numpy."""
+    code = (
+        "import sys, detective, detective.core, detective.config, detective.time; "
+        "detective.HassDatabase; from detective import *; "
+        "print(sorted({'numpy', 'pandas', 'pytz'} & set(sys.modules)))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
+
+
 def test_fetch_entities(mock_db):
     with patch.object(
         mock_db,
@@ -29,27 +45,40 @@ def test_fetch_entities(mock_db):
     assert mock_db.entities == ["light.kitchen", "light.living_room", "switch.ac"]
 
 
-mock_data = pd.DataFrame({
-    "state": ["20.2", "50.1"],
-    "last_updated_ts": ["2025-10-01 12:00:00", "2025-10-01 12:05:00"],
-    "entity_id": ["sensor.temperature", "sensor.humidity"],
-    "shared_attrs": ["{}", "{}"]
-})
+def test_resolve_metadata_ids(mock_db):
+    with patch.object(
+        mock_db,
+        "perform_query",
+        return_value=[
+            ["sensor.kitchen_power", 1],
+            ["sensor.kitchen_temperature", 2],
+            ["binary_sensor.door", 3],
+            ["automation.sensor_x", 4],
+        ],
+    ) as mock_query:
+        assert mock_db.resolve_metadata_ids(domains=("sensor",)) == [1, 2]
+        patterns = ("sensor.*_power", "binary_sensor.door")
+        assert mock_db.resolve_metadata_ids(patterns) == [1, 3]
+        assert mock_db.resolve_metadata_ids(("sensor.missing",)) == []
+
+    # The entity_id -> metadata_id map is only loaded once.
+    assert mock_query.call_count == 1
 
-@patch("sqlalchemy.create_engine")
-def test_fetch_all_sensor_data(mock_create_engine):
+
+def test_fetch_all_sensor_data():
     """Test that fetch_all_sensor_data returns a Pandas DataFrame."""
-    mock_con = MagicMock()
-    mock_engine = MagicMock()
-    mock_engine.connect.return_value = mock_con
-    mock_create_engine.return_value = mock_engine
+    db = HassDatabase(url="sqlite:///tests/test.db", fetch_entities=False)
+
+    result = db.fetch_all_sensor_data()
+    assert isinstance(result, pd.DataFrame)
+    assert result.entity_id.str.startswith("sensor.").all()
 
-    # fetch_all_sensor_data uses read_sql_query under the hood
-    with patch("pandas.read_sql_query") as mock_read_sql:
-        mock_read_sql.return_value = mock_data
 
-        db = HassDatabase(url="sqlite:///tests/test.db", fetch_entities=False)
-        db.con = mock_con
+def test_explain_query_on_mariadb(mock_db):
+    mock_db.db_type = "mysql"
+    query = text("SELECT state FROM states")
 
-        result = db.fetch_all_sensor_data()
-        assert isinstance(result, pd.DataFrame)
+    mock_db.engine.dialect.is_mariadb = False
+    assert mock_db._explain_query(query, {}).text.startswith("EXPLAIN ANALYZE ")
+    mock_db.engine.dialect.is_mariadb = True
+    assert mock_db._explain_query(query, {}).text.startswith("ANALYZE FORMAT=JSON ")
@@ -1,6 +1,11 @@
+import sqlite3
+
 import detective.core as detective
 import detective.functions as functions
+import numpy as np
 import pandas as pd
+import pytest
+import sqlalchemy
 
 db_url = "sqlite:///tests/test.db"
 
@@ -24,3 +29,494 @@ def test_db():
 
     df = db.fetch_all_statistics_of(("sensor.kitchen", "sensor.living_room", "sensor.ac"), limit=100000)
     assert df is not None
+
+
+def test_iter_all_data_of_yields_bounded_chunks():
+    db = detective.HassDatabase(db_url, fetch_entities=False)
+    full = db.fetch_all_data_of(("sun.sun", "zone.home"), limit=None)
+
+    chunks = list(db.iter_all_data_of(("sun.sun", "zone.home"), chunksize=1))
+
+    assert len(chunks) == len(full)
+    assert all(len(chunk) <= 1 for chunk in chunks)
+    pd.testing.assert_frame_equal(
+        pd.concat(chunks, ignore_index=True), full, check_dtype=False
+    )
+
+
+def test_fetch_all_data_of_time_range_and_keyset_pages():
+    db = detective.HassDatabase(db_url, fetch_entities=False)
+    sensors = ("sun.sun", "zone.home", "sensor.sun_next_dawn")
+    full = db.fetch_all_data_of(sensors, limit=None)
+    assert full.last_updated_ts.is_monotonic_decreasing
+
+    newest = full.iloc[0]
+    in_range = db.fetch_all_data_of(
+        sensors, start=full.last_updated_ts.min(), end=newest.last_updated_ts
+    )
+    assert len(in_range) == len(full) - 1
+
+    first_page = db.fetch_all_data_of(sensors, limit=2)
+    last = first_page.iloc[-1]
+    second_page = db.fetch_all_data_of(
+        sensors, limit=2, after=(last.last_updated_ts, last.state_id)
+    )
+    assert list(first_page.state_id) + list(second_page.state_id) == list(
+        full.state_id
+    )
+
+
+def test_fetch_all_sensor_data_only_returns_sensor_domain():
+    db = detective.HassDatabase(db_url, fetch_entities=False)
+    df = db.fetch_all_sensor_data()
+    assert len(df) > 0
+    assert df.entity_id.str.startswith("sensor.").all()
+
+
+def test_fetch_all_data_of_batches_large_entity_lists(monkeypatch):
+    db = detective.HassDatabase(db_url)
+    expected = db.fetch_all_data_of(db.entities, limit=5)
+
+    monkeypatch.setattr(detective, "ENTITY_BATCH_SIZE", 2)
+    batched = db.fetch_all_data_of(db.entities, limit=5)
+
+    pd.testing.assert_frame_equal(batched, expected, check_dtype=False)
+
+
+def test_fetch_all_statistics_of_binds_statistic_ids(db_path):
+    with sqlite3.connect(db_path) as con:
+        con.executemany(
+            "INSERT INTO statistics_meta (id, statistic_id, source, has_mean, has_sum) "
+            "VALUES (?, ?, 'recorder', 1, 0)",
+            [(1, "sensor.o'brien_power"), (2, "external:kitchen")],
+        )
+        con.executemany(
+            "INSERT INTO statistics (created_ts, metadata_id, start_ts, mean) "
+            "VALUES (?, ?, ?, ?)",
+            [(3600.0, 1, 0.0, 1.0), (7200.0, 2, 3600.0, 2.0)],
+        )
+
+    db = detective.HassDatabase(f"sqlite:///{db_path}", fetch_entities=False)
+    df = db.fetch_all_statistics_of(("sensor.o'brien_power", "external.kitchen"))
+
+    assert list(df.statistic_id) == ["external:kitchen", "sensor.o'brien_power"]
+
+
+def test_fetch_all_sensor_data_expands_attributes():
+    db = detective.HassDatabase(db_url, fetch_entities=False)
+    df = db.fetch_all_sensor_data(attributes=functions.DEFAULT_ATTRIBUTES)
+    assert set(functions.DEFAULT_ATTRIBUTES) <= set(df.columns)
+    assert df.friendly_name.notna().all()
+
+
+@pytest.mark.parametrize("backend", ["arrow", "polars"])
+def test_columnar_backends_match_pandas(backend):
+    pytest.importorskip("pyarrow")
+    if backend == "polars":
+        pytest.importorskip("polars")
+    sensors = ("sun.sun", "zone.home")
+    expected = detective.HassDatabase(db_url).fetch_all_data_of(sensors)
+
+    db = detective.HassDatabase(db_url, backend=backend)
+    frame = db.fetch_all_data_of(sensors)
+    chunks = list(db.iter_all_data_of(sensors, chunksize=1))
+
+    assert len(chunks) == len(expected)
+    pd.testing.assert_frame_equal(frame.to_pandas(), expected, check_dtype=False)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        detective.HassDatabase(db_url, backend="spark")
+
+
+@pytest.mark.parametrize("backend", ["pandas", "arrow", "polars"])
+def test_fetch_all_sensor_data_converts_epoch_on_client(backend):
+    if backend != "pandas":
+        pytest.importorskip(backend if backend == "polars" else "pyarrow")
+    db = detective.HassDatabase(db_url, fetch_entities=False, backend=backend)
+    df = db.fetch_all_sensor_data()
+    if backend != "pandas":
+        df = df.to_pandas()
+
+    assert pd.api.types.is_datetime64_any_dtype(df.last_updated_ts)
+    oldest = pd.Timestamp("2023-04-01 04:39:46.024")
+    assert abs(df.last_updated_ts.iloc[-1] - oldest) < pd.Timedelta("1ms")
+
+
+def test_read_only_pool_is_reused_and_closed(db_path):
+    with detective.HassDatabase(f"sqlite:///{db_path}", read_only=True) as db:
+        result = db.perform_query("SELECT entity_id FROM states_meta")
+        db.fetch_all_data_of(("sun.sun",))
+        list(db.iter_all_data_of(("sun.sun",)))
+
+        # All connections went back to the pool and the result was buffered.
+        assert db.engine.pool.checkedout() == 0
+        assert len(result.all()) == len(db.entities)
+
+        with pytest.raises(sqlalchemy.exc.OperationalError):
+            db.perform_query("DELETE FROM states")
+
+
+def test_fetch_many_matches_sequential_fetches():
+    db = detective.HassDatabase(db_url, fetch_entities=False)
+    sensors = ("sun.sun", "sensor.*")
+    expected = pd.concat(
+        [
+            db.fetch_all_data_of((entity,), limit=None)
+            for entity in db.resolve_entities(sensors)
+        ],
+        ignore_index=True,
+    )
+
+    result = db.fetch_many(sensors, workers=3)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    result = db.fetch_many(
+        sensors, start=1680323985, end=1680323987, workers=3, period="100ms"
+    )
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_fetch_aggregated_matches_pandas_resample(db_path):
+    values = ["1", "2", "3.5", "unavailable", "-4", "10", "on", "1e1"]
+    with sqlite3.connect(db_path) as con:
+        con.execute("INSERT INTO states_meta VALUES (100, 'sensor.power')")
+        con.executemany(
+            "INSERT INTO states (state, last_updated_ts, metadata_id) "
+            "VALUES (?, ?, 100)",
+            [(value, 1680000000.0 + 100 * i) for i, value in enumerate(values)],
+        )
+
+    db = detective.HassDatabase(f"sqlite:///{db_path}", fetch_entities=False)
+    aggs = ("mean", "min", "max", "first", "last", "count")
+    result = db.fetch_aggregated(("sensor.power", "zone.home"), "5min", aggs)
+
+    raw = functions.format_dataframe(db.fetch_all_data_of(("sensor.power",)))
+    expected = (
+        raw.set_index("last_updated_ts")
+        .sort_index()["state"]
+        .resample("5min")
+        .agg(list(aggs))
+        .dropna()
+    )
+    power = result[result.entity_id == "sensor.power"].set_index("bucket")
+    pd.testing.assert_frame_equal(
+        power[list(aggs)],
+        expected,
+        check_dtype=False,
+        check_names=False,
+        check_freq=False,
+        check_index_type=False,
+    )
+    assert list(result.entity_id.unique()) == ["sensor.power", "zone.home"]
+
+    wide = db.fetch_aggregated(("sensor.power",), 600, aggs=("min",), wide=True)
+    assert list(wide[("min", "sensor.power")]) == [-4, 10]
+
+
+def test_fetch_series_stitches_statistics_and_states(db_path):
+    hour = 1680000000.0 - 1680000000.0 % 3600
+    with sqlite3.connect(db_path) as con:
+        con.execute("INSERT INTO states_meta VALUES (100, 'sensor.power')")
+        con.execute(
+            "INSERT INTO statistics_meta (id, statistic_id, source, has_mean) "
+            "VALUES (1, 'sensor.power', 'recorder', 1)"
+        )
+        # Two hours of hourly statistics, then short term statistics for the
+        # third hour and raw states for the fourth.
+        con.executemany(
+            "INSERT INTO statistics (metadata_id, start_ts, mean, min, max) "
+            "VALUES (1, ?, ?, ?, ?)",
+            [(hour, 1.0, 0.0, 2.0), (hour + 3600, 2.0, 1.0, 3.0)],
+        )
+        con.executemany(
+            "INSERT INTO statistics_short_term (metadata_id, start_ts, mean, min, max) "
+            "VALUES (1, ?, ?, ?, ?)",
+            [(hour + 3600 * 2 + 300 * i, 3.0, 3.0 - i, 3.0 + i) for i in range(12)],
+        )
+        con.executemany(
+            "INSERT INTO states (state, last_updated_ts, metadata_id) "
+            "VALUES (?, ?, 100)",
+            [("100", hour + 3600 * 2 + 10), ("4", hour + 3600 * 3 + 10)],
+        )
+
+    db = detective.HassDatabase(f"sqlite:///{db_path}", fetch_entities=False)
+    series = db.fetch_series(("sensor.power",), bucket="1h")
+
+    assert list(series.bucket) == list(
+        pd.to_datetime([hour + 3600 * i for i in range(4)], unit="s")
+    )
+    assert list(series["mean"]) == [1.0, 2.0, 3.0, 4.0]
+    assert list(series["min"]) == [0.0, 1.0, -8.0, 4.0]
+
+    # 5 minute buckets can't be read from the hourly statistics.
+    series = db.fetch_series(("sensor.power",), bucket="5min", aggs=("max",))
+    assert len(series) == 13
+    assert series["max"].iloc[0] == 3.0
+
+
+def test_fetch_matrix_matches_asof_matrix(db_path):
+    t0 = 1680000000.0
+    states = [
+        (100, "1", t0 - 50),
+        (100, "2", t0 + 30),
+        (100, "on", t0 + 90),
+        (100, "3", t0 + 120),
+        (101, "20", t0 + 70),
+        (101, "21", t0 + 150),
+    ]
+    with sqlite3.connect(db_path) as con:
+        con.execute("INSERT INTO states_meta VALUES (100, 'sensor.power')")
+        con.execute("INSERT INTO states_meta VALUES (101, 'sensor.temperature')")
+        con.executemany(
+            "INSERT INTO states (metadata_id, state, last_updated_ts) VALUES (?, ?, ?)",
+            states,
+        )
+
+    db = detective.HassDatabase(f"sqlite:///{db_path}", fetch_entities=False)
+    sensors = ("sensor.power", "sensor.temperature")
+    matrix = db.fetch_matrix(sensors, start=t0, end=t0 + 240, freq="1min")
+
+    assert matrix.dtypes.unique().tolist() == ["float32"]
+    assert matrix.index[0] == pd.Timestamp(t0, unit="s")
+    # The state from before the start fills the first row.
+    assert matrix["sensor.power"].tolist() == [1, 2, 3, 3]
+    assert matrix["sensor.temperature"].iloc[2:].tolist() == [20, 21]
+    assert matrix["sensor.temperature"].iloc[:2].isna().all()
+
+    raw = db.fetch_all_data_of(sensors, limit=None)
+    expected = functions.asof_matrix(raw, matrix.index)
+    pd.testing.assert_frame_equal(matrix, expected, check_index_type=False)
+
+    anchored = db.fetch_matrix(
+        ("sensor.power",), start=t0, end=t0 + 240, anchor="sensor.temperature"
+    )
+    assert anchored["sensor.power"].tolist() == [2, 3]
+
+
+def test_queries_are_instrumented(caplog):
+    recorded = []
+    db = detective.HassDatabase(
+        db_url, fetch_entities=False, explain=True, on_query=recorded.append
+    )
+
+    with caplog.at_level("DEBUG", logger="detective.core"):
+        df = db.fetch_all_data_of(("sun.sun", "zone.home"))
+    chunks = list(db.iter_all_data_of(("sun.sun", "zone.home"), chunksize=1))
+
+    stats = recorded[-2]
+    assert stats.rows == len(df) == len(chunks)
+    assert stats.bytes > 0
+    assert stats.total == stats.execute + stats.fetch + stats.build > 0
+    assert "USING INDEX" in stats.plan
+    assert recorded[-1].rows == len(chunks)
+    assert any("FROM states" in record.message for record in caplog.records)
+
+    summary = db.stats()
+    assert summary.loc[stats.query, "count"] == 1
+    assert summary.loc[stats.query, "rows"] == len(df)
+    assert list(summary.columns) == [
+        "count",
+        "seconds",
+        "mean",
+        "execute",
+        "fetch",
+        "build",
+        "rows",
+        "bytes",
+    ]
+
+
+def test_tail_polls_above_watermark_and_backs_off(db_path, tmp_path, monkeypatch):
+    watermark = tmp_path / "watermark.json"
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 3:
+            with sqlite3.connect(db_path) as con:
+                con.execute("INSERT INTO states_meta VALUES (200, 'sensor.new')")
+                con.executemany(
+                    "INSERT INTO states (state_id, state, last_updated_ts, "
+                    "metadata_id) VALUES (?, ?, 1680324000.0, ?)",
+                    [(10, "new", 3), (11, "new entity", 200)],
+                )
+
+    monkeypatch.setattr(detective, "sleep", sleep)
+    monkeypatch.setattr(detective, "ENTITY_BATCH_SIZE", 2)
+    db = detective.HassDatabase(f"sqlite:///{db_path}", fetch_entities=False)
+
+    batches = db.tail(("sensor.*",), 0, batch_size=4, watermark_path=watermark)
+    assert list(next(batches).state_id) == [3, 4, 5, 6]
+    assert list(next(batches).state_id) == [7, 8]
+    batch = next(batches)
+    assert list(batch.state) == ["new", "new entity"]
+    assert list(batch.columns) == ["state", "last_updated_ts", "entity_id", "state_id"]
+    batches.close()
+
+    # Full batches are followed right away, empty polls double the wait.
+    assert sleeps == [1.0, 1.0, 2.0]
+    # The last batch was not acknowledged by asking for the next one.
+    assert watermark.read_text() == '{"since_state_id": 8}'
+    resumed = db.tail(("sensor.*",), watermark_path=watermark)
+    assert list(next(resumed).state_id) == [10, 11]
+
+
+def test_fetch_series_routes_each_entity(db_path):
+    hour = 1680000000.0 - 1680000000.0 % 3600
+    with sqlite3.connect(db_path) as con:
+        con.execute("INSERT INTO states_meta VALUES (100, 'sensor.power')")
+        con.execute("INSERT INTO states_meta VALUES (101, 'sensor.nostats')")
+        con.execute(
+            "INSERT INTO statistics_meta (id, statistic_id, source, has_mean) "
+            "VALUES (1, 'sensor.power', 'recorder', 1)"
+        )
+        # Statistics of sensor.power only cover its third and fourth hour.
+        con.executemany(
+            "INSERT INTO statistics (metadata_id, start_ts, mean, min, max) "
+            "VALUES (1, ?, ?, 0, 9)",
+            [(hour + 3600 * 2, 2.0), (hour + 3600 * 3, 3.0)],
+        )
+        con.executemany(
+            "INSERT INTO states (state, last_updated_ts, metadata_id) "
+            "VALUES (?, ?, ?)",
+            [(str(i), hour + 3600 * i + 10, 101) for i in range(6)]
+            + [
+                ("100", hour + 10, 100),
+                ("1", hour + 3610, 100),
+                ("50", hour + 7210, 100),
+            ],
+        )
+
+    db = detective.HassDatabase(f"sqlite:///{db_path}", fetch_entities=False)
+    series = db.fetch_series(("sensor.power", "sensor.nostats"), aggs=("mean",))
+
+    nostats = series[series.entity_id == "sensor.nostats"]
+    expected = db.fetch_series(("sensor.nostats",), aggs=("mean",))
+    assert list(nostats["mean"]) == list(expected["mean"]) == [0, 1, 2, 3, 4, 5]
+    power = series[series.entity_id == "sensor.power"]
+    assert list(power["mean"]) == [100.0, 1.0, 2.0, 3.0]
+    assert list(power.bucket) == list(
+        pd.to_datetime([hour + 3600 * i for i in range(4)], unit="s")
+    )
+
+    assert db.fetch_series(("sensor.missing",)).empty
+
+
+@pytest.mark.parametrize("backend", ["pandas", "arrow", "polars"])
+def test_fetch_all_sensor_data_keyset_pages(backend, db_path):
+    # Timestamps with more digits than a datetime keeps.
+    timestamps = np.random.default_rng(0).uniform(1680000000, 1680100000, 50)
+    with sqlite3.connect(db_path) as con:
+        con.executemany(
+            "INSERT INTO states (state, last_updated_ts, metadata_id) "
+            "VALUES ('1', ?, 3)",
+            [(ts,) for ts in timestamps],
+        )
+    db = detective.HassDatabase(
+        f"sqlite:///{db_path}", fetch_entities=False, backend=backend
+    )
+    full = detective._to_pandas(db.fetch_all_sensor_data(limit=None), backend)
+
+    state_ids = []
+    after = None
+    for _ in range(len(full) + 1):
+        page = db.fetch_all_sensor_data(limit=2, after=after)
+        page = detective._to_pandas(page, backend)
+        if page.empty:
+            break
+        state_ids.extend(page.state_id)
+        last = page.iloc[-1]
+        after = (last.last_updated_ts, last.state_id)
+
+    assert state_ids == list(full.state_id)
+
+
+def test_numeric_states_match_to_numeric(db_path):
+    states = ["192.168.1.10", "2024.1.0", "2024-01-15", "12.5", "-.5", "1e3", "+4"]
+    with sqlite3.connect(db_path) as con:
+        con.executemany(
+            "INSERT INTO states (state, last_updated_ts, metadata_id) "
+            "VALUES (?, ?, 3)",
+            [(state, 1680400000.0 + i) for i, state in enumerate(states)],
+        )
+    db = detective.HassDatabase(f"sqlite:///{db_path}", fetch_entities=False)
+
+    df = db.fetch_aggregated(
+        ("sensor.sun_next_dawn",), "1D", aggs=("count", "sum"), start=1680400000
+    )
+    numbers = pd.to_numeric(pd.Series(states), errors="coerce")
+    assert df["count"].sum() == numbers.count() == 4
+    assert df["sum"].sum() == pytest.approx(numbers.sum())
+
+
+def test_iter_all_data_of_limits_rows_across_batches(monkeypatch):
+    monkeypatch.setattr(detective, "ENTITY_BATCH_SIZE", 2)
+    db = detective.HassDatabase(db_url, fetch_entities=False)
+
+    chunks = list(db.iter_all_data_of(("sensor.*",), chunksize=2, limit=3))
+
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert db.queries[-1].rows == 3
+
+
+def test_fetch_series_reads_sum_only_statistics_from_states(db_path):
+    hour = 1680000000.0 - 1680000000.0 % 3600
+    with sqlite3.connect(db_path) as con:
+        con.execute("INSERT INTO states_meta VALUES (100, 'sensor.energy')")
+        con.execute(
+            "INSERT INTO statistics_meta (id, statistic_id, source, has_mean, "
+            "has_sum) VALUES (1, 'sensor.energy', 'recorder', 0, 1)"
+        )
+        # A total_increasing sensor only has sum and state statistics.
+        con.executemany(
+            "INSERT INTO statistics (metadata_id, start_ts, sum, state) "
+            "VALUES (1, ?, ?, ?)",
+            [(hour + 3600 * i, float(i), 10.0 + i) for i in range(3)],
+        )
+        con.executemany(
+            "INSERT INTO states (state, last_updated_ts, metadata_id) "
+            "VALUES (?, ?, 100)",
+            [(str(10 + i), hour + 3600 * i + 10) for i in range(3)],
+        )
+
+    db = detective.HassDatabase(f"sqlite:///{db_path}", fetch_entities=False)
+    series = db.fetch_series(("sensor.energy",))
+
+    expected = db.fetch_aggregated(("sensor.energy",), "1h")
+    for agg in ("mean", "min", "max"):
+        assert list(series[agg]) == list(expected[agg]) == [10, 11, 12]
+
+
+def test_arrow_backend_reads_sqlite_with_adbc(db_path, caplog):
+    pytest.importorskip("adbc_driver_sqlite")
+    with sqlite3.connect(db_path) as con:
+        con.execute(
+            "INSERT INTO statistics_meta (id, statistic_id, source, has_mean, "
+            "has_sum) VALUES (1, 'sensor.energy', 'recorder', 0, 1)"
+        )
+        # The newest sums, which ADBC infers the column type from, are NULL.
+        con.executemany(
+            "INSERT INTO statistics (created_ts, metadata_id, start_ts, sum) "
+            "VALUES (?, 1, ?, ?)",
+            [(3600.0 * i, 3600.0 * i, i if i < 100 else None) for i in range(3000)],
+        )
+    url = f"sqlite:///{db_path}"
+    native = detective.HassDatabase(url, fetch_entities=False, backend="arrow")
+    rows = detective.HassDatabase(url, fetch_entities=False, backend="arrow")
+    rows._adbc_uri = None
+
+    fetches = [
+        lambda db: db.fetch_all_sensor_data(limit=None),
+        lambda db: db.fetch_all_statistics_of(("sensor.energy",), limit=None),
+        lambda db: db.fetch_aggregated(("sensor.*",), "1h"),
+    ]
+    with caplog.at_level("DEBUG", logger="detective.core"):
+        for fetch in fetches:
+            assert fetch(native).to_pandas().equals(fetch(rows).to_pandas())
+
+    # The statistics and the REGEXP of fetch_aggregated fall back to SQLAlchemy.
+    failed = [record for record in caplog.records if "ADBC" in record.message]
+    assert len(failed) == 2
+    assert native.fetch_all_statistics_of(("sensor.energy",))["sum"].null_count == 2900
@@ -1,7 +1,12 @@
 """Tests for helper functions."""
+import json
+from unittest.mock import patch
+
+import numpy as np
 import pandas as pd
+import pytest
 
-from detective.functions import format_dataframe
+from detective.functions import OnlineStats, expand_attributes, format_dataframe
 
 
 def test_format_dataframe_converts_types_and_drops_invalid_rows():
@@ -33,3 +38,142 @@ def test_format_dataframe_removes_timezone_information():
     result = format_dataframe(df)
 
     assert result.iloc[0]["last_updated_ts"].tzinfo is None
+
+
+def test_expand_attributes_decodes_each_blob_once():
+    df = pd.DataFrame(
+        {
+            "attributes_id": [1, 2, 1, None],
+            "shared_attrs": [
+                '{"unit_of_measurement": "W", "device_class": "power"}',
+                '{"unit_of_measurement": "kWh", "precision": 2}',
+                '{"unit_of_measurement": "W", "device_class": "power"}',
+                None,
+            ],
+        }
+    )
+
+    with patch("detective.functions.json_loads", side_effect=json.loads) as loads:
+        result = expand_attributes(
+            df, keys=("unit_of_measurement", "device_class", "precision")
+        )
+
+    assert loads.call_count == 2
+    assert list(result["unit_of_measurement"].astype(object)) == [
+        "W",
+        "kWh",
+        "W",
+        np.nan,
+    ]
+    assert isinstance(result["unit_of_measurement"].dtype, pd.CategoricalDtype)
+    assert pd.api.types.is_float_dtype(result["precision"])
+    assert result["precision"].iloc[1] == 2
+    assert "unit_of_measurement" not in df
+
+
+def test_format_dataframe_compact_dtypes_and_chosen_dropna():
+    df = pd.DataFrame(
+        {
+            "state": ["1.5", "on", "2"],
+            "last_updated_ts": [1.5, 60.25, 120.0],
+            "entity_id": ["sensor.a", "sensor.a", "sensor.b"],
+            "shared_attrs": [None, "{}", None],
+        }
+    )
+
+    result = format_dataframe(
+        df, float_dtype="float32", categorical=True, timestamps="epoch"
+    )
+
+    # Rows are only dropped for a missing state, not missing attributes.
+    assert list(result["state"]) == [1.5, 2.0]
+    assert result["state"].dtype == np.float32
+    assert isinstance(result["entity_id"].dtype, pd.CategoricalDtype)
+    assert list(result["last_updated_ts"]) == [1500, 120000]
+    # The input is left untouched.
+    assert list(df["state"]) == ["1.5", "on", "2"]
+
+    result = format_dataframe(df)
+    # Full precision by default.
+    assert result["last_updated_ts"].iloc[0] == pd.Timestamp(1.5, unit="s")
+
+    result = format_dataframe(
+        df, numeric=False, timestamps="datetime_ms", inplace=True
+    )
+    assert result is df
+    assert isinstance(df["state"].dtype, pd.CategoricalDtype)
+    assert df["last_updated_ts"].dtype == "datetime64[ms]"
+
+
+def test_format_dataframe_inplace_drops_rows_by_position():
+    chunk = pd.DataFrame({"state": ["1", "on"], "last_updated_ts": [1.0, 2.0]})
+    other = pd.DataFrame({"state": ["3", "4"], "last_updated_ts": [3.0, 4.0]})
+    df = pd.concat([chunk, other])
+
+    expected = format_dataframe(df)
+    result = format_dataframe(df, inplace=True)
+
+    assert result is df
+    assert list(expected["state"]) == list(df["state"]) == [1.0, 3.0, 4.0]
+    assert list(df.index) == [0, 0, 1]
+
+
+def test_online_stats_match_batch_statistics(tmp_path):
+    rng = np.random.default_rng(0)
+    ids = rng.choice([3, 7, 8], size=3000)
+    values = rng.normal(ids * 10.0, ids, size=3000)
+    values[::100] = np.nan
+
+    stats = OnlineStats(quantiles=(0.1, 0.5, 0.9), alpha=0.05)
+    for batch in np.array_split(np.arange(3000), [1, 2, 500, 2999]):
+        stats.update(ids[batch], values[batch])
+
+    df = pd.DataFrame({"id": ids, "value": values}).dropna()
+    grouped = df.groupby("id")["value"]
+    summary = stats.to_frame()
+    assert list(summary.index) == [3, 7, 8]
+    np.testing.assert_array_equal(summary["count"], grouped.count())
+    np.testing.assert_allclose(summary["mean"], grouped.mean())
+    np.testing.assert_allclose(summary["std"], grouped.std())
+    ewma = grouped.apply(lambda s: s.ewm(alpha=0.05, adjust=False).mean().iloc[-1])
+    np.testing.assert_allclose(summary["ewma"], ewma)
+    for p in (0.1, 0.5, 0.9):
+        exact = grouped.quantile(p)
+        np.testing.assert_allclose(summary[f"q{p:g}"], exact, atol=0.1 * exact.std())
+
+    stats.save(tmp_path / "stats.npz")
+    loaded = OnlineStats.load(tmp_path / "stats.npz")
+    pd.testing.assert_frame_equal(loaded.to_frame(), summary)
+
+
+def test_online_stats_score_frames():
+    stats = OnlineStats(quantiles=(0.5,))
+    metadata_ids = {"sensor.power": 2, "sensor.other": 5}
+    history = pd.DataFrame(
+        {
+            "entity_id": ["sensor.power"] * 4 + ["sensor.other"],
+            "state": ["12", "8", "10", "10", "on"],
+            "last_updated_ts": [4.0, 1.0, 2.0, 3.0, 1.0],
+        }
+    )
+    assert stats.update_frame(history, metadata_ids).isna().all()
+
+    new = pd.DataFrame(
+        {
+            "entity_id": ["sensor.power", "sensor.power", "sensor.unknown"],
+            "state": ["20", "unavailable", "1"],
+            "last_updated_ts": [5.0, 6.0, 5.0],
+        },
+        index=[10, 11, 12],
+    )
+    scores = stats.update_frame(new, metadata_ids)
+    assert scores[10] == pytest.approx(10 / np.std([8, 10, 10, 12], ddof=1))
+    assert scores[[11, 12]].isna().all()
+
+    summary = stats.to_frame(metadata_ids)
+    assert summary.loc["sensor.power", "count"] == 5
+    assert summary.loc["sensor.power", "q0.5"] == 10
+    # The EWMA follows the states in time order: 8, 10, 10, 12 and 20.
+    ewma = pd.Series([8, 10, 10, 12, 20.0]).ewm(alpha=0.1, adjust=False).mean()
+    assert summary.loc["sensor.power", "ewma"] == pytest.approx(ewma.iloc[-1])
+    assert len(stats) == 1
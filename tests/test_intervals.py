@@ -0,0 +1,78 @@
+"""Tests for state intervals."""
+import numpy as np
+import pandas as pd
+
+from detective.intervals import StateIntervals
+
+HOUR = 3600
+# 2023-04-01 00:00:00 UTC
+MIDNIGHT = 1680307200
+
+
+def states():
+    # Newest first, the way fetch_all_data_of returns them.
+    rows = [
+        ("light.desk", "off", MIDNIGHT + 30 * HOUR),
+        ("light.desk", "on", MIDNIGHT + 22 * HOUR),
+        ("light.desk", "on", MIDNIGHT + 20 * HOUR),
+        ("light.desk", "off", MIDNIGHT + 2 * HOUR),
+        ("light.desk", "on", MIDNIGHT + 1 * HOUR),
+        ("person.anne", "home", MIDNIGHT),
+        ("person.anne", "away", MIDNIGHT + 36 * HOUR),
+    ]
+    return pd.DataFrame(rows, columns=["entity_id", "state", "last_updated_ts"])
+
+
+def test_intervals_merge_duplicate_states():
+    intervals = StateIntervals.from_frame(states())
+
+    assert len(intervals) == 6
+    assert intervals.entities == ["light.desk", "person.anne"]
+    assert intervals.offsets.tolist() == [0, 4, 6]
+
+    desk = intervals.to_frame().query("entity_id == 'light.desk'")
+    assert desk["state"].tolist() == ["on", "off", "on", "off"]
+    assert desk["duration"].tolist() == [
+        pd.Timedelta(hours=1),
+        pd.Timedelta(hours=18),
+        pd.Timedelta(hours=10),
+        pd.Timedelta(hours=6),
+    ]
+
+
+def test_intervals_from_frames_merge_across_chunks():
+    df = states()
+    chunks = [df.iloc[:2], df.iloc[2:4], df.iloc[4:]]
+
+    intervals = StateIntervals.from_frames(chunks)
+
+    expected = StateIntervals.from_frame(df)
+    assert np.array_equal(intervals.starts, expected.starts)
+    assert np.array_equal(intervals.ends, expected.ends)
+
+
+def test_state_at():
+    intervals = StateIntervals.from_frame(states())
+
+    assert intervals.state_at("light.desk", pd.Timestamp("2023-04-01 01:30")) == "on"
+    assert intervals.state_at("light.desk", pd.Timestamp("2023-03-31")) is None
+    result = intervals.state_at(
+        "person.anne", pd.to_datetime(["2023-04-01 12:00", "2023-04-02 12:00"])
+    )
+    assert result.tolist() == ["home", "away"]
+
+
+def test_total_time_per_day():
+    intervals = StateIntervals.from_frame(states())
+
+    on = intervals.total_time("on")
+
+    assert on.index.tolist() == [pd.Timestamp("2023-04-01"), pd.Timestamp("2023-04-02")]
+    assert on["light.desk"].tolist() == [pd.Timedelta(hours=5), pd.Timedelta(hours=6)]
+    assert (on["person.anne"] == pd.Timedelta(0)).all()
+
+    local = intervals.total_time("on", tz="Europe/Amsterdam")
+    assert local["light.desk"].tolist() == [
+        pd.Timedelta(hours=3),
+        pd.Timedelta(hours=8),
+    ]
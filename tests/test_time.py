@@ -1,7 +1,9 @@
 """Tests for time helper."""
-from datetime import datetime
+from datetime import datetime, timedelta
 from time import time as builtin_time
+from time import tzset as builtin_tzset
 
+import pandas as pd
 import pytest
 
 from detective import time
@@ -34,3 +36,66 @@ def test_localize():
     # There is always a little offset because of how LOCAL_UTC_OFFSET is
     # calculated. We calculate here it's not more than 1 second off
     assert -1 < (time.localize(utcnow) - now).total_seconds() < 1
+
+
+def test_to_timestamp():
+    assert time.to_timestamp(1700000000) == 1700000000.0
+    assert time.to_timestamp(datetime(2023, 11, 14, 22, 13, 20)) == 1700000000.0
+    assert time.to_timestamp("2023-11-14T22:13:20+00:00") == 1700000000.0
+    assert time.to_timestamp("2023-11-14 23:13:20+01:00") == 1700000000.0
+
+
+def test_vectorized_helpers_match_scalar_helpers():
+    datetimes = [
+        datetime(2023, 4, 1, hour, 30, tzinfo=time.UTC) + timedelta(days=hour % 7)
+        for hour in range(24)
+    ]
+    series = pd.Series(datetimes, index=range(10, 34))
+
+    categories = time.time_categories(series)
+    assert list(categories.cat.categories) == time.TIME_CATEGORIES
+    assert list(categories.index) == list(series.index)
+    assert list(categories) == [time.time_category(dt) for dt in datetimes]
+
+    weekdays = [time.is_weekday(dt) for dt in datetimes]
+    assert list(time.weekday_mask(series)) == weekdays
+
+    localized = [time.localize(dt) for dt in datetimes]
+    assert list(time.localize_series(series)) == localized
+
+    strings = [dt.strftime("%Y-%m-%d %H:%M:%S.%f") for dt in datetimes]
+    assert list(time.sqlalch_datetimes(strings)) == [
+        time.sqlalch_datetime(string) for string in strings
+    ]
+    assert list(time.sqlalch_datetimes(series)) == datetimes
+    with pytest.raises(ValueError):
+        time.sqlalch_datetimes(["garbage"])
+
+
+@pytest.fixture
+def amsterdam(monkeypatch):
+    monkeypatch.setenv("TZ", "Europe/Amsterdam")
+    builtin_tzset()
+    yield
+    monkeypatch.undo()
+    builtin_tzset()
+
+
+def test_localize_is_dst_aware(amsterdam):
+    summer = datetime(2023, 7, 1, 12, tzinfo=time.UTC)
+    winter = datetime(2023, 1, 1, 12, tzinfo=time.UTC)
+    series = pd.Series([summer, winter])
+
+    assert time.localize(summer) == datetime(2023, 7, 1, 14)
+    assert time.localize(winter) == datetime(2023, 1, 1, 13)
+    assert time.localize(pd.Timestamp(winter)) == datetime(2023, 1, 1, 13)
+    assert list(time.localize_series(series)) == [
+        datetime(2023, 7, 1, 14),
+        datetime(2023, 1, 1, 13),
+    ]
+
+    assert time.localize(summer, "America/New_York") == datetime(2023, 7, 1, 8)
+    assert list(time.localize_series(series, "America/New_York")) == [
+        datetime(2023, 7, 1, 8),
+        datetime(2023, 1, 1, 7),
+    ]